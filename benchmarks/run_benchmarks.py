@@ -0,0 +1,251 @@
+"""Times the editing, navigation, save and export paths of fixMasks on
+synthetic datasets, and compares the results against a baseline file.
+Runs headless: the GUI in main.py is never imported.
+
+    python -m benchmarks.run_benchmarks --sizes 1000 10000 100000
+    python -m benchmarks.run_benchmarks --sizes 1000 --update
+
+Results are seconds per operation. A benchmark is reported as a
+regression when it is slower than the baseline by more than the
+tolerance, in which case the exit code is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from fixMasks import iris
+from fixMasks.iris import IrisDataset, IrisImage
+from fixMasks.util import export_masks_as_images
+
+from .synthetic import generate_dataset, reset_work
+
+BASELINE_FILE = Path(__file__).with_name('baseline.json')
+DEFAULT_SIZES = (1000, 10000, 100000)
+_TOLERANCE = 1.5  # Slowdown over the baseline reported as a regression
+_N_OPS = 200  # Operations timed by each benchmark
+_CHECKED_FRACTION = 0.3  # Images marked as checked in the datasets
+BENCHMARKS = {}
+
+
+def benchmark(name, any_shape=False):
+    """Registers a benchmark. Benchmarks are run from root/work, on a
+    freshly reset synthetic dataset. They receive the root folder, the
+    number of images and the image shape, and return seconds per
+    operation. Unless any_shape is True, they only run for the shape of
+    the real datasets, as IrisDataset is bound to it.
+    """
+    def register(fn):
+        BENCHMARKS[name] = (fn, any_shape)
+        return fn
+    return register
+
+
+def _timed(fn, n_ops):
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) / n_ops
+
+
+def _random_image(shape, rng):
+    data = rng.integers(0, 256, shape[0] * shape[1], dtype='uint8')
+    mask = (rng.random(shape[0] * shape[1]) < 0.2).astype('uint8')
+    return IrisImage(data, mask, tuple(shape) + (1,))
+
+
+@benchmark('draw_on_mask', any_shape=True)
+def bench_draw(root, n_images, shape):
+    rng = np.random.default_rng(0)
+    image = _random_image(shape, rng)
+    points = rng.integers(0, shape, (_N_OPS, 2))
+
+    def run():
+        for point in points:
+            image.draw_on_mask(tuple(point), 5)
+    return _timed(run, _N_OPS)
+
+
+@benchmark('draw_stroke', any_shape=True)
+def bench_stroke(root, n_images, shape):
+    rng = np.random.default_rng(0)
+    image = _random_image(shape, rng)
+    strokes = rng.integers(0, shape, (_N_OPS, 8, 2))
+
+    def run():
+        for stroke in strokes:
+            image.draw_stroke([tuple(p) for p in stroke], 5)
+    return _timed(run, _N_OPS)
+
+
+@benchmark('get_visualization', any_shape=True)
+def bench_visualization(root, n_images, shape):
+    image = _random_image(shape, np.random.default_rng(0))
+
+    def run():
+        for _ in range(_N_OPS):
+            image.get_visualization(0.5)
+    return _timed(run, _N_OPS)
+
+
+@benchmark('dataset_open')
+def bench_open(root, n_images, shape):
+    datasets = []
+    # The first open, which warms the file cache, is not timed
+    IrisDataset().close()
+    result = _timed(lambda: datasets.append(IrisDataset()), 1)
+    datasets[0].close()
+    return result
+
+
+@benchmark('next_with_skips')
+def bench_next(root, n_images, shape):
+    dataset = IrisDataset()
+
+    def run():
+        for _ in range(_N_OPS):
+            dataset.next([1], True)
+    result = _timed(run, _N_OPS)
+    dataset.close()
+    return result
+
+
+@benchmark('save_to_disk')
+def bench_save(root, n_images, shape):
+    dataset = IrisDataset()
+    rng = np.random.default_rng(0)
+    elapsed = 0.0
+    for point in rng.integers(0, shape, (_N_OPS, 2)):
+        dataset.next()
+        dataset.irisimage.draw_on_mask(tuple(point), 5)
+        # The journal and compaction writes happen on the writer thread
+        elapsed += _timed(lambda: (dataset.save(True, False),
+                                   dataset.flush(wait=True)), 1)
+    dataset.close()
+    return elapsed / _N_OPS
+
+
+@benchmark('export_masks_as_images', any_shape=True)
+def bench_export(root, n_images, shape):
+    out_shapes = [(shape[0] // 2, shape[1] // 2),
+                  (shape[0] // 4, shape[1] // 4)]
+    out_folder = Path(root) / 'export'
+    result = _timed(lambda: export_masks_as_images(
+        out_folder, out_shapes, orig_shape=tuple(shape), incremental=False,
+        gen_new_visualization=True), n_images)
+    shutil.rmtree(out_folder)
+    return result
+
+
+def run_benchmarks(sizes, shape=iris._OSIRIS_SHAPE, names=None,
+                   root=None) -> dict:
+    """Runs the benchmarks in names (all if None) for each number of
+    images in sizes. Returns a {size: {benchmark: seconds per op}}
+    dict. Synthetic datasets are generated in root, or in a temporary
+    folder that is removed afterwards.
+    """
+    names = list(BENCHMARKS) if names is None else names
+    shape = tuple(shape)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            size_root = Path(root or tmp) / str(size)
+            print('Generating {} synthetic images.'.format(size))
+            # Written as the raw cache, so 100k images fit in memory
+            generate_dataset(size_root, size, shape, _CHECKED_FRACTION,
+                             cache_only=True)
+            results[str(size)] = {}
+            for name in names:
+                fn, any_shape = BENCHMARKS[name]
+                if not any_shape and shape != tuple(iris._OSIRIS_SHAPE):
+                    continue
+                old_dir = os.getcwd()
+                os.chdir(size_root / 'work')
+                try:
+                    reset_work(size_root, shape)
+                    seconds = fn(size_root, size, shape)
+                finally:
+                    os.chdir(old_dir)
+                results[str(size)][name] = seconds
+                print('  {:<24} {:.3e} s/op'.format(name, seconds))
+            if root is None:
+                shutil.rmtree(size_root)
+    return results
+
+
+def load_baseline(path=BASELINE_FILE) -> dict:
+    """Returns the baseline file contents, or an empty baseline."""
+    path = Path(path)
+    if not path.exists():
+        return {'meta': {}, 'results': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results: dict, shape, path=BASELINE_FILE):
+    """Merges results into the baseline file."""
+    baseline = load_baseline(path)
+    for size, timings in results.items():
+        baseline['results'].setdefault(size, {}).update(timings)
+    baseline['meta'] = {'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'machine': platform.machine(),
+                        'cpus': os.cpu_count(),
+                        'shape': list(shape)}
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(results: dict, baseline: dict, tolerance=_TOLERANCE) -> list:
+    """Returns (size, benchmark, ratio) for every result slower than
+    its baseline by more than tolerance times.
+    """
+    regressions = []
+    for size, timings in results.items():
+        for name, seconds in timings.items():
+            reference = baseline['results'].get(size, {}).get(name)
+            if reference and seconds / reference > tolerance:
+                regressions.append((size, name, seconds / reference))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=DEFAULT_SIZES)
+    parser.add_argument('--shape', type=int, nargs=2,
+                        default=iris._OSIRIS_SHAPE, metavar=('ROWS', 'COLS'))
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS),
+                        help='Benchmarks to run (default: all)')
+    parser.add_argument('--root', help='Keep the synthetic datasets here')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--tolerance', type=float, default=_TOLERANCE)
+    parser.add_argument('--update', action='store_true',
+                        help='Write the results into the baseline file')
+    parser.add_argument('--output', help='Also write the results here')
+    args = parser.parse_args()
+    results = run_benchmarks(args.sizes, args.shape, args.only, args.root)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.update:
+        save_baseline(results, args.shape, args.baseline)
+        return
+    regressions = compare(results, load_baseline(args.baseline),
+                          args.tolerance)
+    for size, name, ratio in regressions:
+        print('[REGRESSION] {} at {} images: {:.2f}x slower'.format(
+            name, size, ratio))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Generates synthetic datasets with the layout expected by fixMasks:
+    root/
+    ├── data/
+    │   ├── left_[w]x[h].mat
+    │   ├── right_[w]x[h].mat
+    │   ├── labels.mat
+    │   └── cache/  (instead of the .mat files, with --cache-only)
+    └── work/
+        ├── check_masks_full.csv
+        ├── check_masks_generated.csv
+        └── new_masks.npz
+IrisDataset and the export functions are run from root/work.
+"""
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.io import savemat
+
+from fixMasks.iris import _RAW_CACHE_FOLDER, MaskStore
+
+EYES = ('left', 'right')
+N_SCORES = 3  # Scores are drawn from range(N_SCORES)
+_CACHE_CHUNK_SIZE = 1024  # Images generated at a time with cache_only
+_GENERATED_CSV = 'check_masks_generated.csv'  # Kept for reset_work
+
+
+def dataset_name(eye: str, shape: tuple) -> str:
+    """Returns the name of a dataset, e.g. left_480x80 for (80, 480)."""
+    return eye + '_' + 'x'.join(str(i) for i in shape[::-1])
+
+
+def _images_list(names: list) -> np.ndarray:
+    """Builds the imagesList struct array read by convert_raw_dataset."""
+    images_list = np.zeros((len(names), 1), dtype=[('name', 'O')])
+    for i, name in enumerate(names):
+        images_list[i, 0]['name'] = name + '_0'
+    return images_list
+
+
+def _synthetic_masks(rng, n: int, shape: tuple) -> np.ndarray:
+    """Masks occluding a band of rows at the top and at the bottom of
+    each image, as eyelids do.
+    """
+    h, w = shape
+    top = rng.integers(0, h // 4, (n, 1, 1))
+    bottom = h - rng.integers(0, h // 8, (n, 1, 1))
+    rows = np.arange(h)[np.newaxis, :, np.newaxis]
+    masks = (rows < top) | (rows >= bottom)
+    return np.broadcast_to(masks, (n, h, w)).reshape((n, -1)).astype('uint8')
+
+
+def _write_cache(cache_dir: Path, rng, names: list, label_array,
+                 shape: tuple, chunk_size=_CACHE_CHUNK_SIZE):
+    """Writes a dataset straight into the .npy cache that its .mat file
+    would be converted into, chunk_size images at a time.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    n_pixels = shape[0] * shape[1]
+    arrays = {key: np.lib.format.open_memmap(
+        cache_dir / (key + '.npy'), mode='w+', dtype='uint8',
+        shape=(len(names), n_pixels)) for key in ('x', 'masks')}
+    for start in range(0, len(names), chunk_size):
+        n = min(chunk_size, len(names) - start)
+        arrays['x'][start:start + n] = rng.integers(0, 256, (n, n_pixels),
+                                                    dtype='uint8')
+        arrays['masks'][start:start + n] = _synthetic_masks(rng, n, shape)
+    for array in arrays.values():
+        array.flush()
+    np.save(cache_dir / 'y.npy', label_array)
+    np.save(cache_dir / 'list.npy', np.array(names))
+    # There is no .mat file, so the cache is never regenerated
+    with open(cache_dir / 'source.json', 'w') as f:
+        json.dump({'size': None, 'mtime_ns': None}, f)
+
+
+def generate_dataset(root, n_images: int, shape=(80, 480),
+                     checked_fraction=0.0, seed=0, cache_only=False):
+    """Writes n_images synthetic images of the given shape, split
+    between the left and right datasets, together with their labels,
+    a check CSV with random scores and an empty mask file. A fraction
+    checked_fraction of the images is marked as checked. If cache_only
+    is True, the datasets are written in chunks directly as their .npy
+    cache, without .mat files, so they may be larger than the memory.
+    """
+    root = Path(root)
+    (root / 'data').mkdir(parents=True, exist_ok=True)
+    (root / 'work').mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    rows = []
+    labels = []
+    for k, eye in enumerate(EYES):
+        n = n_images // len(EYES) + (k < n_images % len(EYES))
+        names = ['{}{:07n}d{}'.format(eye[0], i, seed) for i in range(n)]
+        label_array = rng.integers(0, 2, (n, 1))
+        if cache_only:
+            _write_cache(root / 'data' / _RAW_CACHE_FOLDER
+                         / dataset_name(eye, shape), rng, names,
+                         label_array, shape)
+        else:
+            savemat(root / 'data' / (dataset_name(eye, shape) + '.mat'), {
+                'dataArray': rng.integers(0, 256, (n, shape[0] * shape[1]),
+                                          dtype='uint8'),
+                'labelArray': label_array,
+                'maskArray': _synthetic_masks(rng, n, shape),
+                'imagesList': _images_list(names)})
+        labels += [(name, label) for name, label in zip(names,
+                                                        label_array[:, 0])]
+        rows += [(eye, name) for name in names]
+    label_cells = np.empty((len(labels), 2), dtype=object)
+    for i, (name, label) in enumerate(labels):
+        label_cells[i, 0] = np.array([name])
+        label_cells[i, 1] = np.array([[label]])
+    savemat(root / 'data' / 'labels.mat', {'labels': label_cells})
+    df = pd.DataFrame(rows, columns=['dataset', 'filename'])
+    df['score'] = rng.integers(0, N_SCORES, len(df))
+    df['checked'] = rng.random(len(df)) < checked_fraction
+    df.to_csv(root / 'work' / _GENERATED_CSV)
+    reset_work(root, shape)
+
+
+def reset_work(root, shape=(80, 480)):
+    """Restores root/work to its generated state: the generated check
+    CSV and an empty mask file, with no journal.
+    """
+    work = Path(root) / 'work'
+    df = pd.read_csv(work / _GENERATED_CSV, index_col=0)
+    df.to_csv(work / 'check_masks_full.csv')
+    MaskStore(len(df), shape[0] * shape[1]).save(work / 'new_masks.npz')
+    journal = work / 'new_masks.journal'
+    if journal.exists():
+        journal.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('root', help='Folder where data/ and work/ go')
+    parser.add_argument('n_images', type=int)
+    parser.add_argument('--shape', type=int, nargs=2, default=(80, 480),
+                        metavar=('ROWS', 'COLS'))
+    parser.add_argument('--checked', type=float, default=0.0,
+                        help='Fraction of images marked as checked')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache-only', action='store_true',
+                        help='Write the .npy cache instead of .mat files')
+    args = parser.parse_args()
+    generate_dataset(args.root, args.n_images, tuple(args.shape),
+                     args.checked, args.seed, args.cache_only)
+
+
+if __name__ == '__main__':
+    main()
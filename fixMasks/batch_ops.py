@@ -0,0 +1,178 @@
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from .iris import _OSIRIS_SHAPE, get_brush_kernel
+from .stats import STATS_COLUMNS, compare_packed_masks
+
+_BATCH_CHUNK_SIZE = 1024  # Masks processed at a time
+
+
+def _as_stack(masks: np.ndarray, shape: tuple) -> np.ndarray:
+    """Reshapes a (N, h*w) stack of masks into a (N, h, w) bool stack."""
+    return np.asarray(masks).reshape((-1,) + tuple(shape)) != 0
+
+
+def _morphology(operation, masks, shape, radius, brush, wrap, border):
+    """Applies a binary morphology operation of ndimage to every mask of
+    a (N, h*w) stack at once, using the brush kernel as structuring
+    element. If wrap is True, the masks are treated as periodic along
+    their width, as the angular axis of a normalized iris is.
+    """
+    stack = _as_stack(masks, shape)
+    kernel = get_brush_kernel(radius, brush)[np.newaxis]
+    pad = kernel.shape[2] // 2 if wrap else 0
+    if pad:
+        stack = np.pad(stack, ((0, 0), (0, 0), (pad, pad)), mode='wrap')
+    stack = operation(stack, structure=kernel, border_value=border)
+    if pad:
+        stack = stack[:, :, pad:-pad]
+    return stack.reshape((stack.shape[0], -1))
+
+
+def dilate(masks: np.ndarray, shape=_OSIRIS_SHAPE, radius=1,
+           brush='circle', wrap=True) -> np.ndarray:
+    """Dilates a (N, h*w) stack of masks with a brush of the given
+    radius. Returns a bool stack of the same shape.
+    """
+    return _morphology(ndimage.binary_dilation, masks, shape, radius, brush,
+                       wrap, 0)
+
+
+def erode(masks: np.ndarray, shape=_OSIRIS_SHAPE, radius=1,
+          brush='circle', wrap=True) -> np.ndarray:
+    """Erodes a (N, h*w) stack of masks with a brush of the given
+    radius. Pixels outside the image count as masked, so regions
+    touching the top or bottom edges are not eroded from them.
+    """
+    return _morphology(ndimage.binary_erosion, masks, shape, radius, brush,
+                       wrap, 1)
+
+
+def opening(masks: np.ndarray, shape=_OSIRIS_SHAPE, radius=1,
+            brush='circle', wrap=True) -> np.ndarray:
+    """Erodes and then dilates a stack of masks, removing masked regions
+    thinner than the brush.
+    """
+    return dilate(erode(masks, shape, radius, brush, wrap), shape, radius,
+                  brush, wrap)
+
+
+def closing(masks: np.ndarray, shape=_OSIRIS_SHAPE, radius=1,
+            brush='circle', wrap=True) -> np.ndarray:
+    """Dilates and then erodes a stack of masks, filling unmasked gaps
+    thinner than the brush.
+    """
+    return erode(dilate(masks, shape, radius, brush, wrap), shape, radius,
+                 brush, wrap)
+
+
+def remove_small_components(masks: np.ndarray, shape=_OSIRIS_SHAPE,
+                            min_size=10, connectivity=8,
+                            wrap=True) -> np.ndarray:
+    """Removes the connected masked regions of fewer than min_size
+    pixels from a (N, h*w) stack of masks. connectivity is 4 or 8. If
+    wrap is True, regions crossing the left and right edges are joined.
+    """
+    if connectivity not in (4, 8):
+        raise ValueError('Connectivity must be 4 or 8')
+    stack = _as_stack(masks, shape)
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(
+        2, 1 if connectivity == 4 else 2)
+    # Each mask is labeled on its own slice of the stack
+    labels, n_labels = ndimage.label(stack, structure=structure)
+    if wrap and n_labels:
+        left, right = labels[:, :, 0], labels[:, :, -1]
+        pairs = [(left, right)]
+        if connectivity == 8:
+            pairs += [(left[:, 1:], right[:, :-1]),
+                      (left[:, :-1], right[:, 1:])]
+        a = np.concatenate([p[0].ravel() for p in pairs])
+        b = np.concatenate([p[1].ravel() for p in pairs])
+        joined = (a != 0) & (b != 0)
+        graph = coo_matrix((np.ones(joined.sum()), (a[joined], b[joined])),
+                           shape=(n_labels + 1, n_labels + 1))
+        _, merged = connected_components(graph, directed=False)
+        labels = np.where(labels != 0, merged[labels] + 1, 0)
+    sizes = np.bincount(labels.ravel())
+    keep = sizes >= min_size
+    keep[0] = False
+    return keep[labels].reshape((stack.shape[0], -1))
+
+
+def select_rows(dataset, scores: list = None, checked: bool = None,
+                datasets: list = None) -> np.ndarray:
+    """Returns the DF rows of an IrisDataset with a score in scores, a
+    checked status equal to checked and a dataset in datasets. Filters
+    that are None are not applied.
+    """
+    df = dataset.df
+    selected = np.ones(len(df), dtype=bool)
+    if scores is not None:
+        selected &= df.score.isin(scores).values
+    if checked is not None:
+        selected &= df.checked.values.astype(bool) == checked
+    if datasets is not None:
+        selected &= df.dataset.isin(datasets).values
+    return np.flatnonzero(selected)
+
+
+def _apply(dataset, get_new_masks, rows, dry_run, chunk_size):
+    """Replaces the current masks of the rows of an IrisDataset by
+    get_new_masks(chunk_rows, chunk_masks), a chunk at a time, and waits
+    until they are written. Returns the statistics of the changes.
+    """
+    if rows is None:
+        rows = np.arange(dataset.n_images)
+    rows = np.asarray(rows, dtype=int)
+    n_pixels = dataset.masks.n_pixels
+    results = []
+    for start in range(0, rows.size, chunk_size):
+        chunk = rows[start:start + chunk_size]
+        masks = dataset.get_masks(chunk)
+        new_masks = get_new_masks(chunk, masks) != 0
+        stats = compare_packed_masks(np.packbits(masks, axis=1),
+                                     np.packbits(new_masks, axis=1), n_pixels)
+        changed = (stats['added'] + stats['removed']) > 0
+        if not dry_run and changed.any():
+            dataset.set_masks(chunk[changed], new_masks[changed],
+                              to_disk=False)
+        stats = pd.DataFrame(stats, index=dataset.df.index[chunk])
+        results.append(pd.concat(
+            [dataset.df.iloc[chunk][['dataset', 'filename', 'score',
+                                     'checked']], stats], axis=1))
+    if not dry_run:
+        dataset.flush(wait=True)
+    if not results:
+        return pd.DataFrame(columns=list(STATS_COLUMNS))
+    return pd.concat(results)
+
+
+def apply_batch(dataset, operation, rows=None, dry_run=False,
+                chunk_size=_BATCH_CHUNK_SIZE) -> pd.DataFrame:
+    """Applies operation, a function from a (N, pixels) stack of masks
+    to a new stack (e.g. functools.partial(opening, radius=2)), to the
+    current masks of the rows of an IrisDataset (all rows if None).
+
+    Changed masks are saved through the dataset's storage, unless
+    dry_run is True, and are on disk when this returns. The dataset must
+    still be closed with close() once done, to compact the journal and
+    stop its writer thread. Either way, returns a DF with the columns of
+    stats.STATS_COLUMNS for each row.
+    """
+    return _apply(dataset, lambda chunk, masks: operation(masks), rows,
+                  dry_run, chunk_size)
+
+
+def reset_to_original(dataset, rows=None, dry_run=False,
+                      chunk_size=_BATCH_CHUNK_SIZE) -> pd.DataFrame:
+    """Resets the masks of the rows of an IrisDataset (all rows if
+    None) to their original masks. Saving and the returned statistics
+    are as in apply_batch.
+    """
+    return _apply(dataset,
+                  lambda chunk, masks: dataset.get_original_masks(chunk),
+                  rows, dry_run, chunk_size)
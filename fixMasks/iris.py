@@ -1,3 +1,16 @@
+import atexit
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
@@ -9,64 +22,610 @@ from scipy.io import loadmat
 _LEFT_OSIRIS_DATASET = 'left_480x80'
 _RIGHT_OSIRIS_DATASET = 'right_480x80'
 _OSIRIS_SHAPE = (80, 480)
+_DATA_FOLDER = Path('../data')
+_RAW_CACHE_FOLDER = 'cache'
+_RAW_CACHE_KEYS = ('x', 'y', 'masks', 'list')
 _CHECK_MASKS_CSV = 'check_masks_full.csv'
+_STATE_DB = 'check_masks.sqlite'  # Used instead of the CSV if it exists
 _MASKS_FILE = 'new_masks.npz'
+_JOURNAL_FILE = 'new_masks.journal'
+_JOURNAL_COMPACT_EVERY = 200  # Records before a background compaction
 _ORIGINAL_LEFT_PATH = Path('S:/NUND_left/')
 _ORIGINAL_RIGHT_PATH = Path('S:/NUND_right/')
+_DATASETS_CONFIG = 'datasets.json'  # Dataset registry, if it exists
+_DATASET_MEMORY_BUDGET = 2**33  # Bytes of datasets kept open
+_LEGACY_CHUNK_SIZE = 64  # Dense mask rows packed at a time on load
+_PREFETCH_AHEAD = 3  # Images prefetched after the current one
+_PREFETCH_BEHIND = 1  # Images prefetched before the current one
+_PREFETCH_CACHE_SIZE = 16
+_UNDO_QUEUE = 500  # Strokes kept in the undo history of each image
+BRUSH_SHAPES = ('circle', 'square', 'ellipse')
+# Width to height ratio of the ellipse brush, matching the normalized iris
+_ELLIPSE_ASPECT = _OSIRIS_SHAPE[1] // _OSIRIS_SHAPE[0]
 
 
-def load_raw_dataset(dataset_name: str):
-    """This function loads a full dataset from a .mat file."""
-    root_folder = Path('../data')
-    data_mat = loadmat(str(root_folder / (dataset_name + '.mat')))
-    data_array = data_mat['dataArray']
-    label_array = data_mat['labelArray']
-    mask_array = data_mat['maskArray']
+def atomic_write(path, write_fn, mode='wb'):
+    """Writes a file through a temporary file that is then renamed over
+    the target, so a crash mid-write never leaves a truncated file.
+    write_fn receives the open temporary file.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, mode) as f:
+        write_fn(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def index_images_list(images_list) -> dict:
+    """Builds a filename -> row index map of an images list. Raises a
+    ValueError if any filename is duplicated.
+    """
+    index = {}
+    duplicates = set()
+    for i, filename in enumerate(images_list):
+        if filename in index:
+            duplicates.add(filename)
+        index[filename] = i
+    if duplicates:
+        raise ValueError('Duplicated filenames in dataset: '
+                         + ', '.join(sorted(duplicates)))
+    return index
+
+
+def convert_raw_dataset(mat_file, cache_dir, chunk_size=512):
+    """Converts a dataset .mat file into a folder of C-ordered .npy
+    files that can be memory-mapped. The folder is written under a
+    temporary name and renamed once complete.
+    """
+    mat_file, cache_dir = Path(mat_file), Path(cache_dir)
+    data_mat = loadmat(str(mat_file))
     images_list = data_mat['imagesList']
     images_list = [
         images_list[i, 0][0][0] for i in range(images_list.shape[0])
     ]
     images_list = np.array(list(map(lambda x: x.split('_')[0], images_list)))
-    data_array.flags.writeable = False
-    label_array.flags.writeable = False
-    mask_array.flags.writeable = False
-    images_list.flags.writeable = False
-    return {
-        'x': data_array,
-        'y': label_array,
-        'masks': mask_array,
+    arrays = {
+        'x': data_mat['dataArray'],
+        'y': data_mat['labelArray'],
+        'masks': data_mat['maskArray'],
         'list': images_list
     }
+    tmp_dir = cache_dir.with_name(cache_dir.name + '.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    for key, array in arrays.items():
+        out = np.lib.format.open_memmap(tmp_dir / (key + '.npy'), mode='w+',
+                                        dtype=array.dtype, shape=array.shape)
+        for start in range(0, array.shape[0], chunk_size):
+            out[start:start + chunk_size] = array[start:start + chunk_size]
+        out.flush()
+        del out
+    source = mat_file.stat()
+    with open(tmp_dir / 'source.json', 'w') as f:
+        json.dump({'size': source.st_size,
+                   'mtime_ns': source.st_mtime_ns}, f)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def _raw_cache_is_valid(mat_file: Path, cache_dir: Path) -> bool:
+    """Returns True if the cache folder exists and was generated from
+    the current version of the .mat file (if it is still available).
+    """
+    if not (cache_dir / 'source.json').exists():
+        return False
+    if not mat_file.exists():
+        return True
+    with open(cache_dir / 'source.json') as f:
+        cached = json.load(f)
+    source = mat_file.stat()
+    return (cached['size'] == source.st_size
+            and cached['mtime_ns'] == source.st_mtime_ns)
+
+
+def _raw_cache(dataset_name: str, root_folder) -> Path:
+    """Returns the cache folder of a dataset, converting its .mat file
+    if the cache is missing or outdated.
+    """
+    root_folder = Path(root_folder)
+    mat_file = root_folder / (dataset_name + '.mat')
+    cache_dir = root_folder / _RAW_CACHE_FOLDER / dataset_name
+    if not _raw_cache_is_valid(mat_file, cache_dir):
+        convert_raw_dataset(mat_file, cache_dir)
+    return cache_dir
+
+
+def load_raw_index(dataset_name: str, root_folder=_DATA_FOLDER) -> dict:
+    """Returns the filename -> row index map of a dataset, reading only
+    the images list of its cache.
+    """
+    cache_dir = _raw_cache(dataset_name, root_folder)
+    return index_images_list(np.load(cache_dir / 'list.npy'))
+
+
+def load_raw_dataset(dataset_name: str, root_folder=_DATA_FOLDER):
+    """This function loads a full dataset from a .mat file. The .mat is
+    converted once into a cache of .npy files, which are then memory-
+    mapped, so only the rows being accessed are read from disk.
+    """
+    cache_dir = _raw_cache(dataset_name, root_folder)
+    dataset = {key: np.load(cache_dir / (key + '.npy'), mmap_mode='r')
+               for key in _RAW_CACHE_KEYS}
+    dataset['index'] = index_images_list(dataset['list'])
+    return dataset
+
+
+class DatasetRegistry:
+    def __init__(self, datasets: dict, memory_budget=_DATASET_MEMORY_BUDGET):
+        """Registry of the datasets of a campaign. datasets maps each
+        name used in the DF's dataset column to a dict with its 'mat'
+        file path, its normalized 'shape' as (rows, cols) and, optionally,
+        its 'originals' folder. Datasets are opened with
+        load_raw_dataset the first time they are accessed, and the least
+        recently used ones are closed when the opened datasets exceed
+        memory_budget bytes. The most recent one is always kept.
+        """
+        self.datasets = {}
+        for name, entry in datasets.items():
+            if 'mat' not in entry or 'shape' not in entry:
+                raise ValueError("Dataset '{}' needs a 'mat' path and a "
+                                 "'shape'".format(name))
+            originals = entry.get('originals')
+            self.datasets[name] = {
+                'mat': Path(entry['mat']),
+                'shape': tuple(int(i) for i in entry['shape']),
+                'originals': Path(originals) if originals else None}
+        self.memory_budget = memory_budget
+        self._open = OrderedDict()  # Name -> (dataset, bytes), LRU order
+        self._indexes = {}  # Name -> filename index, kept when closed
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, path, memory_budget=_DATASET_MEMORY_BUDGET):
+        """Loads a registry from a JSON file of the form
+        {name: {"mat": ..., "shape": [rows, cols], "originals": ...}}.
+        Relative paths are relative to the file's folder.
+        """
+        path = Path(path)
+        with open(path) as f:
+            datasets = json.load(f)
+        for entry in datasets.values():
+            for key in ('mat', 'originals'):
+                if entry.get(key):
+                    entry[key] = path.parent / entry[key]
+        return cls(datasets, memory_budget)
+
+    @classmethod
+    def default(cls, shape=_OSIRIS_SHAPE,
+                memory_budget=_DATASET_MEMORY_BUDGET):
+        """Returns the registry of the left and right datasets normalized
+        to shape, which default to the original ones.
+        """
+        if tuple(shape) == _OSIRIS_SHAPE:
+            left, right = _LEFT_OSIRIS_DATASET, _RIGHT_OSIRIS_DATASET
+        else:
+            size = 'x'.join(str(i) for i in shape[::-1])
+            left, right = 'left_' + size, 'right_' + size
+        return cls({
+            'left': {'mat': _DATA_FOLDER / (left + '.mat'),
+                     'shape': shape,
+                     'originals': _ORIGINAL_LEFT_PATH},
+            'right': {'mat': _DATA_FOLDER / (right + '.mat'),
+                      'shape': shape,
+                      'originals': _ORIGINAL_RIGHT_PATH}
+        }, memory_budget)
+
+    @classmethod
+    def load(cls, shape=_OSIRIS_SHAPE, memory_budget=_DATASET_MEMORY_BUDGET):
+        """Returns the registry in datasets.json if it exists, or else the
+        default one for shape.
+        """
+        if Path(_DATASETS_CONFIG).exists():
+            return cls.from_config(_DATASETS_CONFIG, memory_budget)
+        return cls.default(shape, memory_budget)
+
+    def __contains__(self, name):
+        return name in self.datasets
+
+    def __iter__(self):
+        return iter(self.datasets)
+
+    def __getitem__(self, name) -> dict:
+        """Returns the dataset, as returned by load_raw_dataset, opening
+        it if needed.
+        """
+        with self._lock:
+            if name in self._open:
+                self._open.move_to_end(name)
+                return self._open[name][0]
+            mat_file = self.datasets[name]['mat']
+            dataset = load_raw_dataset(mat_file.stem, mat_file.parent)
+            n_bytes = sum(dataset[key].nbytes for key in _RAW_CACHE_KEYS)
+            self._open[name] = (dataset, n_bytes)
+            while len(self._open) > 1 and self.memory_used() > \
+                    self.memory_budget:
+                self._open.popitem(last=False)
+            return dataset
+
+    def index(self, name) -> dict:
+        """Returns the filename -> row index map of a dataset, without
+        opening its arrays.
+        """
+        with self._lock:
+            if name not in self._indexes:
+                mat_file = self.datasets[name]['mat']
+                self._indexes[name] = load_raw_index(mat_file.stem,
+                                                     mat_file.parent)
+            return self._indexes[name]
+
+    def check(self, names):
+        """Raises a ValueError if any of the names is not registered."""
+        unknown = set(names) - set(self.datasets)
+        if unknown:
+            raise ValueError('Datasets not in the registry: '
+                             + ', '.join(sorted(unknown)))
+
+    def shape(self, name) -> tuple:
+        return self.datasets[name]['shape']
+
+    def originals(self, name) -> Path:
+        return self.datasets[name]['originals']
+
+    def is_open(self, name) -> bool:
+        return name in self._open
+
+    def memory_used(self) -> int:
+        """Returns the bytes of the opened datasets."""
+        return sum(n_bytes for _, n_bytes in self._open.values())
+
+
+@lru_cache(maxsize=None)
+def get_brush_kernel(radius, brush='circle') -> np.ndarray:
+    """Returns the boolean stamp of a brush, centered on its middle
+    pixel. Stamps are cached, so each one is only built once.
+    """
+    if brush not in BRUSH_SHAPES:
+        raise ValueError('Unknown brush: ' + str(brush))
+    radius_y = radius
+    radius_x = radius * _ELLIPSE_ASPECT if brush == 'ellipse' else radius
+    ry, rx = int(np.floor(radius_y)), int(np.floor(radius_x))
+    y, x = np.ogrid[-ry:ry + 1, -rx:rx + 1]
+    if brush == 'square':
+        kernel = np.ones((2*ry + 1, 2*rx + 1), dtype=bool)
+    elif brush == 'circle':
+        kernel = y**2 + x**2 <= radius**2
+    else:
+        kernel = (y / radius_y)**2 + (x / radius_x)**2 <= 1
+    kernel.flags.writeable = False
+    return kernel
+
+
+class MaskStore:
+    def __init__(self, n_rows: int, n_pixels: int):
+        """Bit-packed storage for the binary masks of a dataset. Each
+        mask is kept as 1 bit per pixel and is only unpacked one row at
+        a time, when requested. Rows that have been set, even to an
+        empty mask, are flagged in saved.
+        """
+        self.n_rows = int(n_rows)
+        self.n_pixels = int(n_pixels)
+        self.packed = np.zeros((self.n_rows, -(-self.n_pixels // 8)),
+                               dtype=np.uint8)
+        self.saved = np.zeros(self.n_rows, dtype=bool)
+        self.journal_seq = 0  # Last journal record included in the file
+
+    @classmethod
+    def from_dense(cls, masks: np.ndarray, chunk_size=256):
+        """Creates a store from a dense (N, M) mask array. Rows are
+        packed in chunks to avoid creating large temporary arrays.
+        """
+        store = cls(masks.shape[0], masks.shape[1])
+        for start in range(0, store.n_rows, chunk_size):
+            chunk = masks[start:start + chunk_size, :] != 0
+            store.packed[start:start + chunk_size, :] = np.packbits(
+                chunk, axis=1)
+        store.saved[:] = store.packed.any(axis=1)
+        return store
+
+    @classmethod
+    def load(cls, path, n_rows: int = None, n_pixels: int = None):
+        """Loads a store from a .npz file. Both the packed format and
+        the legacy dense 'masks' array are supported. If the file does
+        not exist, an empty store of (n_rows, n_pixels) is returned.
+        Files without saved flags have the rows with a mask flagged.
+        Legacy files are packed while they are streamed, so their dense
+        array is never fully in memory.
+        """
+        if not Path(path).exists():
+            if n_rows is None or n_pixels is None:
+                raise FileNotFoundError(path)
+            return cls(n_rows, n_pixels)
+        with np.load(path) as npz:
+            legacy = 'packed' not in npz
+            if not legacy:
+                store = cls(npz['packed'].shape[0], int(npz['n_pixels']))
+                store.packed[:] = npz['packed']
+                if 'saved' in npz:
+                    store.saved[:] = npz['saved']
+                else:
+                    store.saved[:] = store.packed.any(axis=1)
+                if 'journal_seq' in npz:
+                    store.journal_seq = int(npz['journal_seq'])
+        if legacy:
+            info = cls.read_info(path)
+            store = cls(info['n_rows'], info['n_pixels'])
+            for start, rows in cls.iter_chunks(path, _LEGACY_CHUNK_SIZE):
+                store.packed[start:start + rows.shape[0]] = rows
+            store.saved[:] = store.packed.any(axis=1)
+        if n_rows is not None and store.n_rows != n_rows:
+            raise ValueError('Mask file has {} rows, expected {}'.format(
+                store.n_rows, n_rows))
+        return store
+
+    @staticmethod
+    def _read_npy_header(f):
+        """Reads the header of a .npy file member, leaving f at the start
+        of its data. Returns its shape, Fortran order flag and dtype.
+        """
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            return np.lib.format.read_array_header_1_0(f)
+        return np.lib.format.read_array_header_2_0(f)
+
+    @staticmethod
+    def read_info(path) -> dict:
+        """Returns the number of rows, the number of pixels per row, the
+        journal sequence number and the saved flags (None if the file
+        has none) of a .npz file, without decompressing its masks.
+        """
+        with zipfile.ZipFile(path) as npz_zip:
+            names = npz_zip.namelist()
+            key = 'packed.npy' if 'packed.npy' in names else 'masks.npy'
+            with npz_zip.open(key) as f:
+                shape = MaskStore._read_npy_header(f)[0]
+            info = {'n_rows': shape[0], 'n_pixels': shape[1],
+                    'journal_seq': 0, 'saved': None}
+            for name in ('n_pixels', 'journal_seq', 'saved'):
+                if key == 'packed.npy' and name + '.npy' in names:
+                    with npz_zip.open(name + '.npy') as f:
+                        info[name] = np.lib.format.read_array(f)
+        info['n_pixels'] = int(info['n_pixels'])
+        info['journal_seq'] = int(info['journal_seq'])
+        return info
+
+    @staticmethod
+    def iter_chunks(path, chunk_size=256, updates: dict = None):
+        """Streams the packed masks of a .npz file, decompressing only
+        chunk_size rows at a time. Yields (start, packed_rows) pairs.
+        Legacy files with a dense 'masks' array are packed on the fly.
+        Rows in updates, a {row: packed_row} dict, are replaced by their
+        packed row.
+        """
+        updates = updates or {}
+        with zipfile.ZipFile(path) as npz_zip:
+            names = npz_zip.namelist()
+            key = 'packed.npy' if 'packed.npy' in names else 'masks.npy'
+            with npz_zip.open(key) as f:
+                shape, fortran_order, dtype = MaskStore._read_npy_header(f)
+                if fortran_order:
+                    raise ValueError('Fortran ordered masks not supported')
+                row_bytes = shape[1] * dtype.itemsize
+                for start in range(0, shape[0], chunk_size):
+                    n = min(chunk_size, shape[0] - start)
+                    rows = np.frombuffer(f.read(n * row_bytes), dtype=dtype)
+                    rows = rows.reshape((n, shape[1]))
+                    if key == 'masks.npy':
+                        rows = np.packbits(rows != 0, axis=1)
+                    updated = [row for row in range(start, start + n)
+                               if row in updates]
+                    if updated:
+                        rows = rows.copy()
+                        for row in updated:
+                            rows[row - start] = updates[row]
+                    yield start, rows
+
+    def save(self, path, packed: np.ndarray = None, journal_seq=None,
+             saved: np.ndarray = None):
+        """Atomically saves the packed masks to a .npz file. A snapshot
+        of the packed array, its journal sequence number and its saved
+        flags may be supplied instead of the current state.
+        """
+        if packed is None:
+            packed = self.packed
+        if journal_seq is None:
+            journal_seq = self.journal_seq
+        if saved is None:
+            saved = self.saved
+        atomic_write(path, lambda f: np.savez_compressed(
+            f, packed=packed, n_pixels=self.n_pixels,
+            journal_seq=journal_seq, saved=saved))
+
+    def get_row(self, index: int) -> np.ndarray:
+        """Returns the unpacked mask of a row as a uint8 vector of 0s
+        and 1s.
+        """
+        return np.unpackbits(self.packed[index, :],
+                             count=self.n_pixels)
+
+    def set_row(self, index: int, mask: np.ndarray):
+        """Packs and stores a flat binary mask in the selected row."""
+        mask = np.asarray(mask).reshape(-1)
+        if mask.shape[0] != self.n_pixels:
+            raise ValueError('Mask has {} pixels, expected {}'.format(
+                mask.shape[0], self.n_pixels))
+        self.packed[index, :] = np.packbits(mask != 0)
+        self.saved[index] = True
+
+    def has_mask(self, index: int) -> bool:
+        """Returns True if the row has at least one masked pixel."""
+        return bool(self.packed[index, :].any())
+
+    def __len__(self):
+        return self.n_rows
+
+
+class MaskJournal:
+    _MAGIC = b'FMJ1'
+    # magic, seq, row, checked, score, payload length, crc32
+    _HEADER = struct.Struct('<4sQIbbII')
+
+    def __init__(self, path, row_bytes: int):
+        """Append-only log of saved rows. Each record holds the full
+        state of one row (packed mask, checked flag and score), so
+        appending costs the same regardless of the dataset size, and
+        replaying is idempotent. A truncated or corrupt record ends the
+        replay, discarding only the write that was interrupted, and is
+        cut off the file before the next append.
+        """
+        self.path = Path(path)
+        self.row_bytes = row_bytes
+        self.seq = 0
+        self._valid_end = 0  # End offset of the last valid record read
+        self._lock = threading.Lock()
+        self._file = None
+
+    def replay(self):
+        """Yields (seq, row, checked, score, packed_row) for every valid
+        record in the journal, in order.
+        """
+        self._valid_end = 0
+        if not self.path.exists():
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + self._HEADER.size <= len(data):
+            magic, seq, row, checked, score, length, crc = \
+                self._HEADER.unpack_from(data, offset)
+            start = offset + self._HEADER.size
+            payload = data[start:start + length]
+            if magic != self._MAGIC or len(payload) != length or \
+                    length != self.row_bytes:
+                break
+            head = data[offset:offset + self._HEADER.size - 4]
+            if zlib.crc32(payload, zlib.crc32(head)) != crc:
+                break
+            self.seq = max(self.seq, seq)
+            self._valid_end = start + length
+            yield (seq, row, bool(checked), score,
+                   np.frombuffer(payload, dtype=np.uint8))
+            offset = start + length
+
+    def updates(self, after_seq=0) -> dict:
+        """Returns the latest {row: (packed_row, checked, score)} state
+        of the rows with records newer than after_seq.
+        """
+        return {row: (packed_row, checked, score)
+                for seq, row, checked, score, packed_row in self.replay()
+                if seq > after_seq}
+
+    def _pack(self, seq, row, checked, score, packed_row):
+        payload = np.ascontiguousarray(packed_row, dtype=np.uint8).tobytes()
+        head = self._HEADER.pack(self._MAGIC, seq, row, int(checked),
+                                 int(score), len(payload), 0)[:-4]
+        crc = zlib.crc32(payload, zlib.crc32(head))
+        return head + struct.pack('<I', crc) + payload
+
+    def append(self, row: int, packed_row: np.ndarray, checked: bool,
+               score: int):
+        """Appends the state of a row to the journal and returns the
+        sequence number of the new record.
+        """
+        return self.append_many([(row, packed_row, checked, score)])
+
+    def append_many(self, records):
+        """Appends (row, packed_row, checked, score) records with a
+        single sync to disk, and returns the last sequence number.
+        """
+        with self._lock:
+            if self._file is None:
+                # Records written after a torn one would never be replayed
+                for _ in self.replay():
+                    pass
+                if self.path.exists() and \
+                        self.path.stat().st_size > self._valid_end:
+                    os.truncate(self.path, self._valid_end)
+                self._file = open(self.path, 'ab')
+            for row, packed_row, checked, score in records:
+                self.seq += 1
+                self._file.write(self._pack(self.seq, row, checked, score,
+                                            packed_row))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            return self.seq
+
+    def truncate(self, up_to_seq: int):
+        """Removes every record with a sequence number of up_to_seq or
+        lower, usually after they have been compacted into the main
+        files.
+        """
+        with self._lock:
+            kept = [self._pack(*record) for record in self.replay()
+                    if record[0] > up_to_seq]
+            self.close()
+            if kept:
+                atomic_write(self.path, lambda f: f.write(b''.join(kept)))
+            elif self.path.exists():
+                self.path.unlink()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return sum(1 for _ in self.replay())
+
+
+def load_journal_updates(npz_file=_MASKS_FILE, journal_file=None) -> dict:
+    """Returns the {row: (packed_row, checked, score)} state of the rows
+    saved to the journal of a mask file but not yet compacted into it,
+    e.g. after an unclean exit. The journal defaults to the mask file
+    with a .journal suffix.
+    """
+    if journal_file is None:
+        journal_file = Path(npz_file).with_suffix('.journal')
+    info = MaskStore.read_info(npz_file)
+    journal = MaskJournal(journal_file, -(-info['n_pixels'] // 8))
+    return journal.updates(info['journal_seq'])
 
 
 class IrisImage:
     def __init__(self, data: np.ndarray, mask: np.ndarray,
                  shape=_OSIRIS_SHAPE + (1,), name='', score=None,
-                 max_queue=20):
+                 max_queue=_UNDO_QUEUE):
         """Class for managing the iris and its mask. Includes undo and
-        redo actions. Data and mask must be flattened.
+        redo actions, which store only the pixels changed by each
+        stroke. Data and mask must be flattened.
         """
         if len(data.shape) == 2:
             self.data = data[0, :]
         else:
             self.data = data
         self.mask = None
+        # Last full visualization, updated in place by dirty regions
+        self._visualization = None
+        self._visualization_alpha = None
+        self.dirty = None  # (y0, y1, x0, x1) changed since last render
         self.set_mask(mask)
         self.shape = shape
-        self.undo_stack = []
-        self.redo_stack = []
+        # Stacks of (indices, before, after) deltas, with the before and
+        # after values of the changed pixels bit-packed
+        self.undo_stack = deque(maxlen=max_queue)
+        self.redo_stack = deque(maxlen=max_queue)
+        self._stroke_base = None  # Packed mask when the stroke started
         self.name = name
         self.score = score
-        self._max_queue = max_queue
 
-    def get_visualization(self, alpha=0.5):
-        """Visualizes the mask on the iris image. Alpha sets the
-        transparency of the mask, with 1 being solid and 0 being
-        invisible.
+    def _render(self, alpha, y0, y1, x0, x1):
+        """Visualizes the mask on the [y0:y1, x0:x1] region of the iris
+        image.
         """
-        visualization = self.data.reshape(self.shape)
+        visualization = self.data.reshape(self.shape)[y0:y1, x0:x1]
         visualization = np.tile(visualization, [1, 1, 3])
-        mask = self.mask.reshape(self.shape[:2])
+        mask = self.mask.reshape(self.shape[:2])[y0:y1, x0:x1]
         # Keep part of the base for visualization
         base_values = visualization[mask == 1, :]
         mask_values = np.tile([[0, 255, 0]], (base_values.shape[0], 1))
@@ -74,143 +633,944 @@ class IrisImage:
                                        + alpha*mask_values)
         return visualization
 
+    def get_visualization(self, alpha=0.5):
+        """Visualizes the mask on the iris image. Alpha sets the
+        transparency of the mask, with 1 being solid and 0 being
+        invisible.
+        """
+        h, w = self.shape[:2]
+        visualization = self._render(alpha, 0, h, 0, w)
+        self._visualization = visualization.copy()
+        self._visualization_alpha = alpha
+        self.dirty = None
+        return visualization
+
+    def get_dirty_visualization(self, alpha=0.5):
+        """Re-renders only the region changed since the last call (or
+        since the last get_visualization) and returns its (y, x) offset
+        and its visualization, which is empty if nothing changed.
+        Returns None if a full get_visualization is required instead.
+        """
+        if self._visualization is None or \
+                self._visualization_alpha != alpha:
+            return None
+        if self.dirty is None:
+            return (0, 0), self._visualization[:0, :0]
+        y0, y1, x0, x1 = self.dirty
+        region = self._render(alpha, y0, y1, x0, x1)
+        self._visualization[y0:y1, x0:x1] = region
+        self.dirty = None
+        return (y0, x0), region
+
+    def _mark_dirty(self, y0, y1, x0, x1):
+        """Adds a region to the area changed since the last render."""
+        h, w = self.shape[:2]
+        y0, y1 = max(0, y0), min(h, y1)
+        x0, x1 = max(0, x0), min(w, x1)
+        if y0 >= y1 or x0 >= x1:
+            return
+        if self.dirty is not None:
+            y0, x0 = min(y0, self.dirty[0]), min(x0, self.dirty[2])
+            y1, x1 = max(y1, self.dirty[1]), max(x1, self.dirty[3])
+        self.dirty = (y0, y1, x0, x1)
+
+    def _stamp_window(self, centers, radius, brush='circle'):
+        """Places the brush stamp on every (y,x) center, clipped to the
+        image. Returns the flat mask indices covered by the stamps and
+        the (y0, y1, x0, x1) window that contains them.
+        """
+        h, w = self.shape[:2]
+        kernel = get_brush_kernel(radius, brush)
+        rows, cols = np.nonzero(kernel)
+        rows = rows - kernel.shape[0] // 2
+        cols = cols - kernel.shape[1] // 2
+        centers = np.rint(np.asarray(centers, dtype=float)).astype(int)
+        y = (centers[:, 0:1] + rows).ravel()
+        x = (centers[:, 1:2] + cols).ravel()
+        inside = (y >= 0) & (y < h) & (x >= 0) & (x < w)
+        y, x = y[inside], x[inside]
+        if not y.size:
+            return np.zeros(0, dtype=int), (0, 0, 0, 0)
+        indices = np.unique(y * w + x)
+        return indices, (y.min(), y.max() + 1, x.min(), x.max() + 1)
+
+    @staticmethod
+    def interpolate_stroke(points) -> np.ndarray:
+        """Returns the (y,x) centers along the polyline defined by
+        points, spaced at most one pixel apart.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        centers = [points[:1]]
+        for p0, p1 in zip(points[:-1], points[1:]):
+            n = int(np.ceil(np.abs(p1 - p0).max()))
+            if n:
+                t = np.arange(1, n + 1)[:, None] / n
+                centers.append(p0 + t * (p1 - p0))
+        return np.concatenate(centers)
+
     def create_circular_mask(self, center, radius) -> np.ndarray:
         """Generates a circular mask. Used for drawing on masks.
         Center is (y,x).
         """
         h, w = self.shape[:2]
-        y, x = np.ogrid[:h, :w]
-        dist_from_center: np.ndarray = np.sqrt(
-            (y - center[0])**2 + (x - center[1])**2)
-        mask = dist_from_center <= radius
-        return mask
-
-    def _base_draw_on_mask(self, coords, radius, value):
-        """Applies the specified value onto a circular area in the mask.
-        The area is defined by (y,x) coords of the center, and the
-        radius of the circle.
-        """
-        draw_mask = self.create_circular_mask(coords, radius)
-        self.mask[draw_mask.flatten()] = value
-
-    def draw_on_mask(self, coords, radius):
-        """Draws a circle of the specified radius on the provided (y,x)
+        mask = np.zeros(h * w, dtype=bool)
+        mask[self._stamp_window([center], radius)[0]] = True
+        return mask.reshape((h, w))
+
+    def _base_draw_stroke(self, points, radius, value, brush='circle'):
+        """Applies the specified value along a stroke in the mask. The
+        stroke is the polyline through the (y,x) points, drawn with the
+        radius and shape of the brush in a single pass.
+        """
+        if self._stroke_base is None:
+            self.save_state()
+        centers = self.interpolate_stroke(points)
+        indices, window = self._stamp_window(centers, radius, brush)
+        self.mask[indices] = value
+        self._mark_dirty(*window)
+
+    def _base_draw_on_mask(self, coords, radius, value, brush='circle'):
+        """Applies the specified value onto the area of a brush in the
+        mask. The area is defined by (y,x) coords of the center, the
+        radius and the shape of the brush. Only the pixels under the
+        brush are accessed.
+        """
+        self._base_draw_stroke([coords], radius, value, brush)
+
+    def draw_on_mask(self, coords, radius, brush='circle'):
+        """Draws a brush of the specified radius on the provided (y,x)
         coordinates.
         """
-        self._base_draw_on_mask(coords, radius, 1)
+        self._base_draw_on_mask(coords, radius, 1, brush)
 
-    def erase_on_mask(self, coords, radius):
-        """Deletes a circle of the specified radius on the provided
+    def erase_on_mask(self, coords, radius, brush='circle'):
+        """Deletes a brush of the specified radius on the provided
         (y,x) coordinates.
         """
-        self._base_draw_on_mask(coords, radius, 0)
+        self._base_draw_on_mask(coords, radius, 0, brush)
+
+    def draw_stroke(self, points, radius, brush='circle'):
+        """Draws a continuous line through the provided (y,x) points."""
+        self._base_draw_stroke(points, radius, 1, brush)
+
+    def erase_stroke(self, points, radius, brush='circle'):
+        """Deletes a continuous line through the provided (y,x) points.
+        """
+        self._base_draw_stroke(points, radius, 0, brush)
+
+    def _end_stroke(self):
+        """Pushes the pixels changed since the stroke started onto the
+        undo stack, and closes the stroke.
+        """
+        if self._stroke_base is None:
+            return
+        before = np.unpackbits(self._stroke_base, count=self.mask.shape[0])
+        self._stroke_base = None
+        indices = np.flatnonzero(before != (self.mask != 0))
+        if not indices.size:
+            return
+        self.undo_stack.append((
+            indices.astype(np.int32),
+            np.packbits(before[indices]),
+            np.packbits(self.mask[indices] != 0)
+        ))
+        self.redo_stack.clear()
+
+    def _apply_delta(self, indices, values):
+        """Sets the packed values on the indices of the mask."""
+        self.mask[indices] = np.unpackbits(values, count=indices.shape[0])
+        w = self.shape[1]
+        self._mark_dirty(indices.min() // w, indices.max() // w + 1,
+                         (indices % w).min(), (indices % w).max() + 1)
 
     def undo(self):
         """Restores the mask to its previous state."""
+        self._end_stroke()
         if self.undo_stack:
-            self.redo_stack.append(self.mask.copy())
-            self.mask = self.undo_stack.pop()
+            indices, before, after = self.undo_stack.pop()
+            self._apply_delta(indices, before)
+            self.redo_stack.append((indices, before, after))
 
     def redo(self):
         """Reverts an undo action."""
+        self._end_stroke()
         if self.redo_stack:
-            self.undo_stack.append(self.mask.copy())
-            self.mask = self.redo_stack.pop()
+            indices, before, after = self.redo_stack.pop()
+            self._apply_delta(indices, after)
+            self.undo_stack.append((indices, before, after))
 
     def save_state(self):
         """Used when starting a new drawing to save the current mask
-        state for the undo stack.
+        state for the undo stack. Drawing without calling this first
+        starts a new drawing too.
+        """
+        self._end_stroke()
+        self._stroke_base = np.packbits(self.mask != 0)
+
+    def get_history(self):
+        """Returns the undo and redo stacks, to be restored with
+        set_history when the image is loaded again.
         """
-        self.undo_stack.append(self.mask.copy())
-        if len(self.undo_stack) > self._max_queue:
-            del self.undo_stack[0]
-        self.redo_stack = []
+        self._end_stroke()
+        return self.undo_stack, self.redo_stack
+
+    def set_history(self, history):
+        """Restores undo and redo stacks returned by get_history."""
+        self._stroke_base = None
+        self.undo_stack, self.redo_stack = history
 
     def set_mask(self, mask):
         if len(mask.shape) == 2:
             self.mask = mask[0, :]
         else:
             self.mask = mask
+        self._visualization = None
+
+
+class ImagePrefetcher:
+    def __init__(self, load_fn, max_items=_PREFETCH_CACHE_SIZE,
+                 n_workers=2):
+        """Loads items in a thread pool ahead of time and keeps them in a
+        bounded LRU cache. load_fn receives the index of an item and
+        returns its loaded value.
+        """
+        self._load_fn = load_fn
+        self._max_items = max_items
+        self._executor = ThreadPoolExecutor(max_workers=n_workers)
+        self._cache = OrderedDict()  # index -> Future
+
+    def prefetch(self, indices):
+        """Starts loading the indices that are not cached yet."""
+        for index in indices:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+            else:
+                self._cache[index] = self._executor.submit(self._load_fn,
+                                                           index)
+        while len(self._cache) > self._max_items:
+            _, future = self._cache.popitem(last=False)
+            future.cancel()
+
+    def get(self, index):
+        """Returns the loaded item, waiting for it if it is still being
+        loaded. Returns None if the item has not been prefetched, or if
+        it was cancelled or failed to load.
+        """
+        future = self._cache.get(index)
+        if future is None or future.cancelled():
+            return None
+        self._cache.move_to_end(index)
+        try:
+            return future.result()
+        except Exception:
+            del self._cache[index]
+            return None
+
+    def cancel(self):
+        """Cancels every prefetch that has not started yet. Items that
+        have already been loaded are kept.
+        """
+        for index, future in list(self._cache.items()):
+            if future.cancel():
+                del self._cache[index]
+
+    def discard(self, index):
+        """Removes an item from the cache."""
+        future = self._cache.pop(index, None)
+        if future is not None:
+            future.cancel()
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=True)
+
+
+class NavigationIndex:
+    def __init__(self, scores, checked):
+        """Score and checked flags of every image, used to find the
+        images that are not skipped without scanning the DF. The sorted
+        indices of the eligible images are cached per skip setting.
+        """
+        self.scores = np.array(scores)
+        self.checked = np.array(checked, dtype=bool)
+        self.n_images = self.scores.shape[0]
+        self._eligible = {}  # (skip, skip_checked) -> sorted indices
+
+    def set_checked(self, index: int, value: bool):
+        """Updates the checked flag of an image, and the cached indices
+        that depend on it.
+        """
+        value = bool(value)
+        if self.checked[index] == value:
+            return
+        self.checked[index] = value
+        for (skip, skip_checked), eligible in self._eligible.items():
+            if not skip_checked or self.scores[index] in skip:
+                continue
+            pos = np.searchsorted(eligible, index)
+            if value:
+                eligible = np.delete(eligible, pos)
+            else:
+                eligible = np.insert(eligible, pos, index)
+            self._eligible[(skip, skip_checked)] = eligible
+
+    def set_score(self, index: int, value: int):
+        """Updates the score of an image. Clears the cached indices."""
+        self.scores[index] = value
+        self._eligible = {}
+
+    def eligible(self, skip: list, skip_checked: bool) -> np.ndarray:
+        """Returns the sorted indices of the images that are not
+        skipped.
+        """
+        key = (tuple(sorted(skip)), bool(skip_checked))
+        if key not in self._eligible:
+            not_skipped = ~np.isin(self.scores, key[0])
+            if skip_checked:
+                not_skipped &= ~self.checked
+            self._eligible[key] = np.flatnonzero(not_skipped)
+        return self._eligible[key]
+
+    def find(self, start: int, step: int, skip: list, skip_checked: bool):
+        """Returns the first index from start (inclusive), moving in the
+        direction of step and wrapping around, whose image is not
+        skipped. Returns None if every image is skipped.
+        """
+        eligible = self.eligible(skip, skip_checked)
+        if not eligible.size:
+            return None
+        start = start % self.n_images
+        if step > 0:
+            pos = np.searchsorted(eligible, start, side='left')
+            return int(eligible[pos % eligible.size])
+        pos = np.searchsorted(eligible, start, side='right') - 1
+        return int(eligible[pos])
+
+
+class ProgressTracker:
+    def __init__(self, datasets, scores, checked):
+        """Counts of total and checked images per (dataset, score) pair,
+        updated as images are checked or unchecked, so the progress can
+        be queried without scanning the DF.
+        """
+        self.datasets = np.array(datasets)
+        self.scores = np.array(scores)
+        self.checked = np.array(checked, dtype=bool)
+        self._totals = {}  # (dataset, score) -> number of images
+        self._counts = {}  # (dataset, score) -> number of checked images
+        for key, is_checked in zip(zip(self.datasets, self.scores),
+                                   self.checked):
+            self._totals[key] = self._totals.get(key, 0) + 1
+            self._counts[key] = self._counts.get(key, 0) + int(is_checked)
+
+    def set_checked(self, index: int, value: bool):
+        """Updates the counts after the checked flag of an image."""
+        value = bool(value)
+        if self.checked[index] == value:
+            return
+        self.checked[index] = value
+        key = (self.datasets[index], self.scores[index])
+        self._counts[key] += 1 if value else -1
+
+    def _sum(self, counts: dict, datasets=None, scores=None):
+        return sum(n for (dataset, score), n in counts.items()
+                   if (datasets is None or dataset in datasets)
+                   and (scores is None or score in scores))
+
+    def n_checked(self, datasets: list = None, scores: list = None):
+        """Returns the number of checked images, optionally only for the
+        supplied datasets and scores.
+        """
+        return self._sum(self._counts, datasets, scores)
+
+    def n_remaining(self, datasets: list = None, scores: list = None):
+        """Returns the number of images not checked yet, optionally only
+        for the supplied datasets and scores.
+        """
+        return (self._sum(self._totals, datasets, scores)
+                - self._sum(self._counts, datasets, scores))
+
+    def is_finished(self, datasets: list = None, scores: list = None):
+        """Returns True if every image (of the supplied datasets and
+        scores) has been checked.
+        """
+        return self.n_remaining(datasets, scores) == 0
+
+
+class StateStore:
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            row INTEGER PRIMARY KEY,
+            dataset TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            checked INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (dataset, filename)
+        );
+        CREATE INDEX IF NOT EXISTS images_checked ON images (checked);
+        CREATE INDEX IF NOT EXISTS images_score ON images (score);
+        CREATE INDEX IF NOT EXISTS images_dataset ON images (dataset);
+    """
+
+    def __init__(self, path):
+        """SQLite database with the check table (dataset, filename,
+        score and checked of each row). Each update is its own
+        transaction and only touches its row. The connection may be used
+        from any thread, but the store is meant for a single process, as
+        the mask file and journal next to it are not shared safely.
+        """
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path),
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            self._conn.executescript(self._SCHEMA)
+
+    @classmethod
+    def import_csv(cls, csv_file, path):
+        """Creates (or replaces the contents of) a store from a check
+        CSV, keeping its row numbers.
+        """
+        df = pd.read_csv(csv_file, index_col=0)
+        store = cls(path)
+        with store._lock, store._conn:
+            store._conn.execute('DELETE FROM images')
+            store._conn.executemany(
+                'INSERT INTO images (row, dataset, filename, score, checked)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                zip(df.index.tolist(), df.dataset, df.filename,
+                    df.score.tolist(), df.checked.astype(int).tolist()))
+        return store
+
+    def export_csv(self, csv_file):
+        """Writes the check table as a CSV, in the format of the check
+        CSV.
+        """
+        df = self.load()
+        atomic_write(csv_file, lambda f: df.to_csv(f), 'w')
+
+    def load(self) -> pd.DataFrame:
+        """Returns the check table as a DF, indexed by row."""
+        with self._lock:
+            df = pd.read_sql_query(
+                'SELECT row, dataset, filename, score, checked FROM images'
+                ' ORDER BY row', self._conn, index_col='row')
+        df.index.name = None
+        df['checked'] = df.checked.astype(bool)
+        return df
+
+    def set_state(self, row: int, checked: bool, score: int):
+        """Updates the checked flag and score of a row."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE images SET checked = ?, score = ? WHERE row = ?',
+                (int(checked), int(score), int(row)))
+
+    def set_states(self, states: dict):
+        """Updates the {row: (checked, score)} states, one transaction
+        per row.
+        """
+        for row in sorted(states):
+            self.set_state(row, *states[row])
+
+    def rows(self, checked: bool = None, scores: list = None,
+             datasets: list = None) -> np.ndarray:
+        """Returns the rows with the given checked status, a score in
+        scores and a dataset in datasets, using the indexes. Filters
+        that are None are not applied.
+        """
+        conditions, params = [], []
+        if checked is not None:
+            conditions.append('checked = ?')
+            params.append(int(checked))
+        for column, values in (('score', scores), ('dataset', datasets)):
+            if values is not None:
+                conditions.append('{} IN ({})'.format(
+                    column, ', '.join('?' * len(values))))
+                params += list(values)
+        query = 'SELECT row FROM images'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY row', params)
+            return np.array([row for row, in rows], dtype=int)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SaveWorker:
+    def __init__(self, write_rows, write_snapshot, write_states=None):
+        """Writer thread with a coalescing queue. Rows queued with
+        put_rows are passed to write_rows as a {row: state} dict, where
+        a row queued again before being written only keeps its latest
+        state. A snapshot queued with put_snapshot replaces any pending
+        snapshot, and the rows queued before it, as it already holds
+        their state. Snapshots are written before the rows queued after
+        them. States queued with put_states are coalesced in the same
+        way as rows, but are never replaced by snapshots, and are passed
+        to write_states last. Anything still queued when the interpreter
+        exits is written before it does.
+        """
+        self._write_rows = write_rows
+        self._write_snapshot = write_snapshot
+        self._write_states = write_states
+        self._rows = {}
+        self._states = {}
+        self._snapshot = None
+        self._busy = False
+        self._closed = False
+        self._error = None
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not (self._queued() or self._closed):
+                    self._condition.wait()
+                if self._closed and not self._queued():
+                    return
+                rows, self._rows = self._rows, {}
+                states, self._states = self._states, {}
+                snapshot, self._snapshot = self._snapshot, None
+                self._busy = True
+            try:
+                if snapshot is not None:
+                    self._write_snapshot(snapshot)
+                if rows:
+                    self._write_rows(rows)
+                if states:
+                    self._write_states(states)
+            except Exception as e:  # Raised again by drain
+                self._error = e
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+
+    def _queued(self) -> bool:
+        return bool(self._rows or self._states
+                    or self._snapshot is not None)
+
+    def put_rows(self, rows: dict):
+        """Queues the {row: state} of changed rows."""
+        with self._condition:
+            self._rows.update(rows)
+            self._condition.notify_all()
+
+    def put_states(self, states: dict):
+        """Queues the {row: state} of rows for write_states."""
+        with self._condition:
+            self._states.update(states)
+            self._condition.notify_all()
+
+    def put_snapshot(self, snapshot):
+        """Queues a snapshot of the full state."""
+        with self._condition:
+            self._snapshot = snapshot
+            self._rows.clear()
+            self._condition.notify_all()
+
+    def pending(self) -> bool:
+        """Returns True if there is anything queued or being written."""
+        with self._condition:
+            return self._queued() or self._busy
+
+    def drain(self):
+        """Waits until everything queued has been written. Raises the
+        last error of the writer thread, if any.
+        """
+        with self._condition:
+            while self._queued() or self._busy:
+                self._condition.wait()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def shutdown(self):
+        """Drains the queue and stops the writer thread."""
+        atexit.unregister(self.shutdown)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self.drain()
 
 
 class IrisDataset:
-    def __init__(self):
-        """Load and handle the dataset."""
+    def __init__(self, keep_history=False, checkpoint_every=None,
+                 registry: DatasetRegistry = None):
+        """Load and handle the dataset. If keep_history is True, the
+        undo history of each image is kept when navigating away from
+        it. If checkpoint_every is given, checkpoint writes the changed
+        rows to disk at most every checkpoint_every seconds. Datasets
+        are opened on demand from the registry, which defaults to the
+        one in datasets.json, or to the left and right datasets.
+        """
         # Must always know which image is the current one, with its
         # latest state
-        self.df = pd.read_csv(_CHECK_MASKS_CSV, index_col=0)
-        self.n_images = len(self.df)
-        self.data = {
-            'left': load_raw_dataset(_LEFT_OSIRIS_DATASET),
-            'right': load_raw_dataset(_RIGHT_OSIRIS_DATASET)
-        }
-        if not Path(_MASKS_FILE).exists():
-            self.masks = np.zeros((self.n_images, np.prod(_OSIRIS_SHAPE)))
+        self.state = None
+        if Path(_STATE_DB).exists():
+            self.state = StateStore(_STATE_DB)
+            self.df = self.state.load()
         else:
-            self.masks = np.load(_MASKS_FILE)['masks']
-        self.cur = None
-        for i in range(self.n_images):
-            if not self.df.checked.loc[i]:
-                self.cur = i
-                break
+            self.df = pd.read_csv(_CHECK_MASKS_CSV, index_col=0)
+        self.n_images = len(self.df)
+        self.data = registry if registry is not None else \
+            DatasetRegistry.load()
+        self.data.check(self.df.dataset)
+        # Position of each row within its dataset. Datasets are only
+        # opened when one of their rows is visited.
+        self._data_index = self._index_rows()
+        # Rows of smaller datasets use the first pixels of the store
+        n_pixels = max(int(np.prod(self.data.shape(key)))
+                       for key in set(self.df.dataset))
+        self.masks = MaskStore.load(_MASKS_FILE, self.n_images, n_pixels)
+        if self.masks.n_pixels != n_pixels:
+            raise ValueError('Mask file has {} pixels per row, expected '
+                             '{}'.format(self.masks.n_pixels, n_pixels))
+        self.journal = MaskJournal(_JOURNAL_FILE, self.masks.packed.shape[1])
+        self._n_journaled = self._replay_journal()
+        self._dirty = set()  # Rows changed since last written to disk
+        self._writer = SaveWorker(self._write_rows, self._write_snapshot,
+                                  self._write_states)
+        self.checkpoint_every = checkpoint_every
+        self._last_checkpoint = time.monotonic()
+        self.nav = NavigationIndex(self.df.score.values,
+                                   self.df.checked.values)
+        self.progress = ProgressTracker(self.df.dataset.values,
+                                        self.df.score.values,
+                                        self.df.checked.values)
+        self.cur = self.nav.find(0, 1, [], True)
         if self.cur is None:
             self.cur = 0
         self._first = True  # Next image will be the first since init
         self.irisimage = None
+        self.keep_history = keep_history
+        self._histories = {}  # Index -> undo history of the image
+        self._history_index = None  # Index of the current Iris Image
+        self.prefetcher = ImagePrefetcher(self._load_row)
+        self._prefetch_skips = None  # Skip settings of the prefetches
+
+    def _index_rows(self) -> np.ndarray:
+        """Returns the position of each DF row within its dataset, from
+        the images lists of the datasets. Raises a ValueError if any row
+        is not found in its dataset.
+        """
+        data_index = np.zeros(self.n_images, dtype=int)
+        missing = []
+        for key in self.df.dataset.unique():
+            index = self.data.index(key)
+            rows = np.flatnonzero(self.df.dataset.values == key)
+            for row, filename in zip(rows, self.df.filename.values[rows]):
+                position = index.get(filename)
+                if position is None:
+                    missing.append(key + '/' + filename)
+                else:
+                    data_index[row] = position
+        if missing:
+            raise ValueError('Images not found in dataset: '
+                             + ', '.join(missing))
+        return data_index
+
+    def _locate(self, row: int):
+        """Returns the dataset of a DF row, opening it if needed, and the
+        position of the row within it.
+        """
+        return self.data[self.df.dataset.values[row]], self._data_index[row]
+
+    def _pad(self, mask: np.ndarray) -> np.ndarray:
+        """Pads a flat mask to the row size of the mask store."""
+        mask = np.asarray(mask).reshape(-1)
+        return np.pad(mask, (0, self.masks.n_pixels - mask.size))
+
+    def _replay_journal(self):
+        """Applies the journal records that are newer than the mask file
+        and returns the number of records in the journal.
+        """
+        n_records = 0
+        replayed = set()
+        for seq, row, checked, score, packed_row in self.journal.replay():
+            n_records += 1
+            if seq <= self.masks.journal_seq:
+                continue
+            self.masks.packed[row, :] = packed_row
+            self.masks.saved[row] = True
+            self.df.loc[row, 'checked'] = checked
+            self.df.loc[row, 'score'] = score
+            replayed.add(row)
+        self.journal.seq = max(self.journal.seq, self.masks.journal_seq)
+        if self.state is not None:
+            # Records may have been written without their state
+            self.state.set_states(self._states(replayed))
+        return n_records
+
+    def _states(self, rows) -> dict:
+        """Returns the {row: (checked, score)} states of the rows."""
+        return {row: (bool(self.df.checked.loc[row]),
+                      int(self.df.score.loc[row])) for row in rows}
+
+    def _write_rows(self, rows: dict):
+        """Appends the {row: (packed_row, checked, score)} states to the
+        journal. Run by the writer thread.
+        """
+        self.journal.append_many(
+            (row, *rows[row]) for row in sorted(rows))
+
+    def _write_states(self, states: dict):
+        """Writes {row: (checked, score)} states to the state store. Run
+        by the writer thread.
+        """
+        self.state.set_states(states)
+
+    def _write_snapshot(self, snapshot):
+        """Writes a (packed, saved, df) snapshot to the mask array and DF
+        files and removes the compacted records from the journal. The DF
+        file is also written when the state store is used, as the export
+        and stats tools read it. Run by the writer thread.
+        """
+        packed, saved, df = snapshot
+        seq = self.journal.seq
+        # The DF goes first: if the mask file is not replaced, its older
+        # sequence number replays the records again.
+        atomic_write(_CHECK_MASKS_CSV, lambda f: df.to_csv(f), 'w')
+        self.masks.save(_MASKS_FILE, packed, seq, saved)
+        self.masks.journal_seq = seq
+        self.journal.truncate(seq)
+
+    def compact(self, background=True):
+        """Writes the full mask array and DF to their files and removes
+        the compacted records from the journal. The files are written by
+        the writer thread; if background is False, waits until they are.
+        """
+        if self.state is not None:
+            self._writer.put_states(self._states(self._dirty))
+        self._dirty.clear()  # Their state is in the snapshot
+        self._n_journaled = 0
+        self._writer.put_snapshot((self.masks.packed.copy(),
+                                   self.masks.saved.copy(), self.df.copy()))
+        if not background:
+            self._writer.drain()
+
+    def checkpoint(self):
+        """Writes the changed rows to disk if checkpoint_every seconds
+        have passed since the last checkpoint. Meant to be called
+        periodically, e.g. on every iteration of the GUI event loop.
+        """
+        if self.checkpoint_every is None:
+            return
+        now = time.monotonic()
+        if now - self._last_checkpoint < self.checkpoint_every:
+            return
+        self._last_checkpoint = now
+        if self._dirty:
+            self.flush()
+
+    def close(self):
+        """Writes any pending changes, compacts the journal and waits for
+        the writer thread to finish.
+        """
+        self.prefetcher.shutdown()
+        if self.irisimage is not None:
+            self.save(checked=False, to_disk=False)
+        self.compact()
+        self._writer.shutdown()
+        self.journal.close()
+        if self.state is not None:
+            self.state.close()
 
     def check_status(self, scores: list = None):
         """Returns True if all images have been checked, or False other-
         wise. If a scores list is supplied, this will only check if
         irises with these scores have been checked.
         """
-        if scores is None:
-            to_check = self.df
-        else:
-            to_check = self.df[self.df.score.isin(scores)]
-        return to_check.checked.all()
+        return self.progress.is_finished(scores=scores)
 
     def is_image_checked(self):
         """Returns whether the current Iris Image has been checked."""
         return self.df.loc[self.cur, 'checked']
 
+    def _load_original_image(self, row: int):
+        """Opens and decodes the original image of a DF row. Returns None
+        if its dataset has no originals folder.
+        """
+        path = self.data.originals(self.df.dataset.loc[row])
+        if path is None:
+            return None
+        filename = self.df.filename.loc[row] + '.tiff'
+        image = Image.open(path / filename)
+        image.load()
+        return image
+
+    def _load_row(self, row: int) -> dict:
+        """Reads the normalized iris, the original mask and the original
+        image of a DF row. Used by the prefetcher.
+        """
+        dataset, index = self._locate(row)
+        loaded = {
+            'data': np.array(dataset['x'][index, :]),
+            'mask': np.array(dataset['masks'][index, :]),
+            'original': None
+        }
+        try:
+            loaded['original'] = self._load_original_image(row)
+        except OSError:
+            pass  # Opened again (and raised) by get_original_image
+        return loaded
+
+    def _prefetch(self, skip: list, skip_checked: bool):
+        """Prefetches the images that would be reached by the next
+        next() and previous() calls with the current skip settings.
+        Pending prefetches are cancelled if these settings changed.
+        """
+        skips = (tuple(sorted(skip)), bool(skip_checked))
+        if skips != self._prefetch_skips:
+            self.prefetcher.cancel()
+            self._prefetch_skips = skips
+        if not self.check_skip(skip, skip_checked):
+            return
+        indices = []
+        for step, n in ((1, _PREFETCH_AHEAD), (-1, _PREFETCH_BEHIND)):
+            index = self.cur
+            for _ in range(n):
+                index = self._find_next(index + step, step, skip,
+                                        skip_checked)
+                indices.append(index)
+        self.prefetcher.prefetch(indices)
+
     def get_irisimage(self):
         """Generates and returns the current Iris Image. Usually called
         from next() or previous().
         """
         row = self.df.loc[self.cur]
-        key = row.dataset
-        index = self.data[key]['list'] == row.filename
-        data = self.data[key]['x'][index, :]
+        shape = self.data.shape(row.dataset)
+        loaded = self.prefetcher.get(self.cur)
+        if loaded is None:
+            dataset, index = self._locate(self.cur)
+            loaded = {'data': dataset['x'][index, :],
+                      'mask': dataset['masks'][index, :]}
+        data = loaded['data']
         # Load mask if it has been previously checked or modified
-        if np.sum(self.masks[self.cur, :]) or self.df.checked.loc[self.cur]:
-            mask = self.masks[self.cur, :].copy()
+        if self.masks.saved[self.cur] or self.df.checked.loc[self.cur]:
+            mask = self.masks.get_row(self.cur)[:shape[0] * shape[1]]
         else:
-            mask = self.data[key]['masks'][index, :].copy()
-        self.irisimage = IrisImage(data, mask, name=row.filename,
-                                   score=row.score)
+            mask = loaded['mask'].copy()
+        if self.keep_history and self.irisimage is not None:
+            self._histories[self._history_index] = \
+                self.irisimage.get_history()
+        self.irisimage = IrisImage(data, mask, shape + (1,),
+                                   name=row.filename, score=row.score)
+        self._history_index = self.cur
+        if self.cur in self._histories:
+            self.irisimage.set_history(self._histories[self.cur])
 
         return self.irisimage
 
     def save(self, checked=True, to_disk=True):
         """Saves the current mask into the mask array. If checked is
         true, sets the current mask as checked in the DF. If to_disk is
-        True, saves the mask array and DF to their corresponding files.
+        True, appends the changed rows to the journal, which is
+        periodically compacted into the mask array and DF files.
         """
         if self.irisimage is None:
             raise ValueError('There is no current Iris Image')
-        self.masks[self.cur, :] = self.irisimage.mask.copy()
+        self.masks.set_row(self.cur, self._pad(self.irisimage.mask))
+        self._dirty.add(self.cur)
         if checked:
-            self.df.loc[self.cur, 'checked'] = True
+            self._set_checked_flag(self.cur, True)
         if to_disk:
-            np.savez_compressed(_MASKS_FILE, masks=self.masks)
-            self.df.to_csv(_CHECK_MASKS_CSV)
+            self.flush()
+
+    def flush(self, wait=False):
+        """Writes the rows changed since the last write to disk, from the
+        writer thread. They are appended to the journal, which is
+        compacted once it holds _JOURNAL_COMPACT_EVERY records. Batches
+        larger than that are compacted directly instead. If wait is
+        True, waits until they are written.
+        """
+        self._last_checkpoint = time.monotonic()
+        if self.state is not None:
+            self._writer.put_states(self._states(self._dirty))
+        if len(self._dirty) >= _JOURNAL_COMPACT_EVERY:
+            self.compact(background=not wait)
+            return
+        self._writer.put_rows({
+            row: (self.masks.packed[row, :].copy(),
+                  bool(self.df.checked.loc[row]),
+                  int(self.df.score.loc[row]))
+            for row in self._dirty})
+        self._n_journaled += len(self._dirty)
+        self._dirty.clear()
+        if self._n_journaled >= _JOURNAL_COMPACT_EVERY:
+            self.compact(background=not wait)
+        elif wait:
+            self._writer.drain()
+
+    def get_original_masks(self, rows) -> np.ndarray:
+        """Returns the original masks of the DF rows, as a (N, pixels)
+        bool stack.
+        """
+        rows = np.asarray(rows, dtype=int)
+        masks = np.zeros((rows.size, self.masks.n_pixels), dtype=bool)
+        datasets = self.df.dataset.values[rows]
+        for key in np.unique(datasets):
+            selected = np.flatnonzero(datasets == key)
+            dataset, _ = self._locate(rows[selected[0]])
+            index = self._data_index[rows[selected]]
+            n_pixels = dataset['masks'].shape[1]
+            masks[selected, :n_pixels] = dataset['masks'][index, :] != 0
+        return masks
+
+    def get_masks(self, rows) -> np.ndarray:
+        """Returns the current masks of the DF rows, as a (N, pixels)
+        bool stack. Rows that have not been saved nor checked have their
+        original mask, as in get_irisimage.
+        """
+        rows = np.asarray(rows, dtype=int)
+        packed = self.masks.packed[rows, :]
+        masks = np.unpackbits(packed, axis=1,
+                              count=self.masks.n_pixels).astype(bool)
+        unsaved = ~(self.masks.saved[rows]
+                    | self.df.checked.values[rows].astype(bool))
+        if unsaved.any():
+            masks[unsaved] = self.get_original_masks(rows[unsaved])
+        return masks
+
+    def set_masks(self, rows, masks, to_disk=True):
+        """Saves a (N, pixels) stack of masks into the DF rows, without
+        changing their checked status. If to_disk is True, the changed
+        rows are written as in save.
+        """
+        rows = np.asarray(rows, dtype=int)
+        self.masks.packed[rows, :] = np.packbits(np.asarray(masks) != 0,
+                                                 axis=1)
+        self.masks.saved[rows] = True
+        self._dirty.update(rows.tolist())
+        if self.irisimage is not None and self.cur in rows:
+            self.irisimage.set_mask(
+                self.masks.get_row(self.cur)[:self.irisimage.mask.size])
+        if to_disk:
+            self.flush()
+
+    def _set_checked_flag(self, row: int, value: bool):
+        """Sets the checked flag of a row in the DF, the navigation
+        index and the progress tracker.
+        """
+        self.df.loc[row, 'checked'] = value
+        self.nav.set_checked(row, value)
+        self.progress.set_checked(row, value)
 
     def set_checked(self, value: bool):
         """Sets the checked status of the current image to value. Having
         the image checked must also correspond to the mask being saved
         to self.masks array.
         """
-        self.df.loc[self.cur, 'checked'] = value
+        self._set_checked_flag(self.cur, value)
+        self._dirty.add(self.cur)
         if value:
             self.save(to_disk=False)
 
@@ -219,73 +1579,68 @@ class IrisDataset:
         list. If the result is False, trying to skip would result in an
         infinite loop.
         """
-        not_skipped = ~self.df.score.isin(skip)
-        if skip_checked:
-            not_skipped = not_skipped & ~self.df.checked
-        return sum(not_skipped) > 0
+        return self.nav.eligible(skip, skip_checked).size > 0
+
+    def _find_next(self, start: int, step: int, skip: list,
+                   skip_checked: bool):
+        """Returns the first index from start (inclusive), moving in the
+        direction of step, whose image is not skipped.
+        """
+        return self.nav.find(start, step, skip, skip_checked)
+
+    def _move(self, step: int, skip: list, skip_checked: bool):
+        """Moves step images, applying the skips, and returns the new
+        current Iris Image.
+        """
+        if skip is None:
+            skip = []
+        if self._first:  # Initialize
+            self._first = False
+        else:
+            self.cur = (self.cur + step) % self.n_images
+            # Sanity check
+            if not self.check_skip(skip, skip_checked):
+                print("[WARNING] All images would be skipped. "
+                      "Ignoring skip.")
+            else:
+                # Apply skips
+                self.cur = self._find_next(self.cur, step, skip,
+                                           skip_checked)
+        irisimage = self.get_irisimage()
+        self._prefetch(skip, skip_checked)
+        return irisimage
 
     def next(self, skip: list = None, skip_checked=False):
         """Returns the next Iris Image. If a skip list is supplied,
         images with a score that is on the list will be skipped. If skip
         _checked is true, checked images will be skipped.
         """
-        if self._first:  # Initialize
-            self._first = False
-            return self.get_irisimage()
-        self.cur = (self.cur + 1) % self.n_images
-        # Sanity check
-        if not self.check_skip(skip, skip_checked):
-            print("[WARNING] All images would be skipped. Ignoring skip.")
-            return self.get_irisimage()
-        # Apply skips
-        while self.df.score.loc[self.cur] in skip or \
-                self.df.checked.loc[self.cur] and skip_checked:
-            self.cur = (self.cur + 1) % self.n_images
-
-        return self.get_irisimage()
+        return self._move(1, skip, skip_checked)
 
     def previous(self, skip: list = None, skip_checked=False):
         """Returns the previous Iris Image. If a skip list is supplied,
         images with a score that is on the list will be skipped. If skip
         _checked is true, checked images will be skipped.
         """
-        if self._first:  # Initialize
-            self._first = False
-            return self.get_irisimage()
-        self.cur = (self.cur - 1) % self.n_images
-        # Sanity check
-        if not self.check_skip(skip, skip_checked):
-            print("[WARNING] All images would be skipped. Ignoring skip.")
-            return self.get_irisimage()
-        # Apply skips
-        while self.df.score.loc[self.cur] in skip or \
-                self.df.checked.loc[self.cur] and skip_checked:
-            self.cur = (self.cur - 1) % self.n_images
-
-        return self.get_irisimage()
+        return self._move(-1, skip, skip_checked)
 
     def reset_mask(self):
         """Resets the current mask to its original state.
         Triggers save_state.
         """
         self.irisimage.save_state()
-        row = self.df.loc[self.cur]
-        key = row.datasekeyt
-        index = self.data[key]['list'] == row.filename
-        mask = self.data[key]['masks'][index, :]
+        dataset, index = self._locate(self.cur)
+        mask = dataset['masks'][index, :].copy()
         self.irisimage.set_mask(mask)
 
     def get_original_image(self):
         """Returns a PIL image containing the original not-normalized
-        iris image.
+        iris image, or None if its dataset has no originals folder.
         """
-        row = self.df.loc[self.cur]
-        if row.dataset == 'left':
-            path = _ORIGINAL_LEFT_PATH
-        else:
-            path = _ORIGINAL_RIGHT_PATH
-        filename = row.filename + '.tiff'
-        return Image.open(path / filename)
+        loaded = self.prefetcher.get(self.cur)
+        if loaded is not None and loaded['original'] is not None:
+            return loaded['original']
+        return self._load_original_image(self.cur)
 
     def get_cur_position(self):
         """Returns a string with current position."""
@@ -293,4 +1648,4 @@ class IrisDataset:
 
     def get_remaining_images(self):
         """Returns the number of images not marked as checked"""
-        return sum(self.df.checked is False)
+        return self.progress.n_remaining()
@@ -1,12 +1,23 @@
+import argparse
 import io
+import json
 import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
 
 # import cv2
 import numpy as np
 from PIL import Image
 import PySimpleGUI as sg
 
-from iris import IrisDataset, IrisImage, _OSIRIS_SHAPE
+from iris import BRUSH_SHAPES, IrisDataset, IrisImage, _OSIRIS_SHAPE
+
+
+_ORIGINAL_CACHE_SIZE = 8  # Encoded original images kept in memory
+_MAX_PATCHES = 64  # Region figures drawn before a full redraw
+_LATENCY_WINDOW = 1000  # Latest times kept per event type and stage
+_TRACE_EVENTS = 100000  # Latest events and stages kept for the trace
+_LATENCY_PANEL_PERIOD = 1.0  # Seconds between latency panel updates
 
 
 def image_to_bytes(image):
@@ -86,6 +97,93 @@ class Timer:
         self._times.pop()
 
 
+class LatencyProfiler:
+    def __init__(self, enabled=False, window=_LATENCY_WINDOW):
+        """Records the wall time of each GUI event, by event type, and
+        of the stages run while handling it. Keeps the latest window
+        times of each for rolling percentiles, and the latest events as
+        a trace. When not enabled, every method does nothing.
+        """
+        self.enabled = enabled
+        self._window = window
+        self._times = {}  # 'event:<type>' or 'stage:<name>' -> times
+        self._trace = deque(maxlen=_TRACE_EVENTS)
+        self._origin = time.perf_counter()
+        self._event = None  # (type, start) of the event being handled
+
+    def _record(self, key, start, end):
+        times = self._times.get(key)
+        if times is None:
+            times = self._times[key] = deque(maxlen=self._window)
+        times.append(end - start)
+        self._trace.append((key, start - self._origin, end - start))
+
+    def start_event(self, event):
+        """Starts timing the handling of an event."""
+        if self.enabled and event is not None:
+            self._event = (str(event), time.perf_counter())
+
+    def end_event(self):
+        """Stops timing the current event, if any."""
+        if self._event is not None:
+            event, start = self._event
+            self._record('event:' + event, start, time.perf_counter())
+            self._event = None
+
+    @contextmanager
+    def _stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record('stage:' + name, start, time.perf_counter())
+
+    def stage(self, name):
+        """Context manager timing a stage, e.g. 'render' or 'encode'."""
+        if not self.enabled:
+            return nullcontext()
+        return self._stage(name)
+
+    def percentiles(self) -> dict:
+        """Returns {key: (count, p50, p95, p99, max)} in seconds, over
+        the latest times of each event type and stage.
+        """
+        stats = {}
+        for key, times in self._times.items():
+            p50, p95, p99 = np.percentile(times, (50, 95, 99))
+            stats[key] = (len(times), p50, p95, p99, max(times))
+        return stats
+
+    def summary(self) -> str:
+        """Returns a table of the percentiles, in milliseconds, sorted by
+        p99.
+        """
+        lines = ['{:<24}{:>6}{:>8}{:>8}{:>8}{:>8}'.format(
+            'ms', 'n', 'p50', 'p95', 'p99', 'max')]
+        stats = sorted(self.percentiles().items(),
+                       key=lambda item: item[1][3], reverse=True)
+        for key, (n, *seconds) in stats:
+            lines.append('{:<24.24}{:>6}'.format(key, n) + ''.join(
+                '{:>8.1f}'.format(s * 1000) for s in seconds))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """Writes the percentiles and the trace to a JSON file. The
+        trace uses the Chrome trace event format, so it can be opened in
+        chrome://tracing or Perfetto.
+        """
+        if not self.enabled:
+            return
+        trace = [{'name': key, 'cat': key.split(':')[0], 'ph': 'X',
+                  'ts': start * 1e6, 'dur': duration * 1e6, 'pid': 0,
+                  'tid': 0}
+                 for key, start, duration in self._trace]
+        stats = {key: dict(zip(('n', 'p50', 'p95', 'p99', 'max'), values))
+                 for key, values in self.percentiles().items()}
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'percentiles': stats}, f)
+
+
 class CheckedText(sg.T):
     def __init__(self):
         super().__init__('NOT CHECKED', s=(15, 1), text_color='red',
@@ -101,15 +199,24 @@ class CheckedText(sg.T):
 
 
 class GUI:
-    def __init__(self, dataset: IrisDataset, debug_mode=True):
+    def __init__(self, dataset: IrisDataset, debug_mode=True,
+                 profiler: LatencyProfiler = None):
         self.dataset = dataset
+        if profiler is None:
+            profiler = LatencyProfiler()
+        self.profiler = profiler
+        self._latency_shown = 0.0  # Time of the last latency panel update
         self.image = None
         self.drawn_image = None
+        self.drawn_patches = []  # Figures drawn over drawn_image
         self.debug_mode = debug_mode
         self.alpha = 0.5  # Alpha value for visualization
         self.draw_mode = True
         self.next_draw_saves = True  # False when in the middle of a drawing
+        self.pending_stroke = []  # Drag points not drawn yet, as (y,x)
+        self.last_stroke_point = None  # Last drawn point of the stroke
         self.timer = Timer()
+        self._original_cache = OrderedDict()  # Index -> encoded original
         # Create layout
         timer_menu = [
             [sg.T('00:00:00', font=('Helvetica', 30), key='-TIME-')],
@@ -125,6 +232,9 @@ class GUI:
             [sg.T('Radius:'), sg.Spin(
                 list(range(1, 11)), 5, readonly=True, key='-RADIUS-'
             ), sg.B('Draw', disabled=True), sg.B('Erase')],
+            [sg.T('Brush:'), sg.Combo(
+                BRUSH_SHAPES, BRUSH_SHAPES[0], readonly=True, key='-BRUSH-'
+            )],
             [sg.B('Undo'), sg.B('Redo'), sg.B('Reset', key='-RESETMASK-')],
             [sg.T('Mask opacity:')],
             [sg.Slider((0.0, 1.0), default_value=0.5, resolution=0.1,
@@ -150,12 +260,16 @@ class GUI:
             [sg.Frame('Skip options', nav_column2)]
         ]
         orig_column = [
-            [sg.Image(key='-ORIGINAL-')]
+            [sg.Image(key='-ORIGINAL-')],
+            [sg.Frame('Latency', [[sg.Multiline(
+                '', s=(64, 14), font=('Courier', 9), write_only=True,
+                key='-LATENCY-')]], visible=self.profiler.enabled)]
         ]
         # Sizes for the canvas
         y, x = _OSIRIS_SHAPE
         self.canv_h = 2 * y
         self.canv_w = 2 * x
+        self.graph_shape = _OSIRIS_SHAPE  # Shape the graph is scaled to
         layout = [
             [sg.T('Current image: None.\tScore: None.\t   0/0', s=(40, 1),
                   key='-NAME-'),
@@ -181,17 +295,68 @@ class GUI:
         self.next()
 
     def update_image(self):
-        # TODO refactor function so it does only one thing
-        # Delete previous figure to prevent memory leak
+        """Refreshes everything related to the current image. Called
+        after navigating to a new image.
+        """
+        self.update_mask_image()
+        self.update_info()
+        self.update_original_image()
+
+    def update_mask_image(self):
+        """Redraws the iris with its mask. Called after each change to
+        the mask or the visualization.
+        """
+        # Delete previous figures to prevent memory leak
         self.window['-IMAGE-'].delete_figure(self.drawn_image)
+        for patch in self.drawn_patches:
+            self.window['-IMAGE-'].delete_figure(patch)
+        self.drawn_patches = []
+        # Datasets may have different shapes, drawn on the same canvas
+        shape = self.image.shape[:2]
+        if shape != self.graph_shape:
+            self.window['-IMAGE-'].change_coordinates((0, shape[0]),
+                                                      (shape[1], 0))
+            self.graph_shape = shape
         # Convert image to Bytes64
-        image = self.image.get_visualization(self.alpha)
-        image = Image.fromarray(image).resize((self.canv_w, self.canv_h),
-                                              Image.NEAREST)
-        data = image_to_bytes(image)
-        # Set image and text
-        self.drawn_image = self.window['-IMAGE-'].draw_image(
-            data=data, location=(0, 0))
+        with self.profiler.stage('render'):
+            image = self.image.get_visualization(self.alpha)
+        with self.profiler.stage('resize'):
+            image = Image.fromarray(image).resize(
+                (self.canv_w, self.canv_h), Image.NEAREST)
+        with self.profiler.stage('encode'):
+            data = image_to_bytes(image)
+        with self.profiler.stage('draw_figure'):
+            self.drawn_image = self.window['-IMAGE-'].draw_image(
+                data=data, location=(0, 0))
+
+    def update_mask_region(self):
+        """Redraws only the region of the mask changed since the last
+        redraw, on top of the current figure. Falls back to a full
+        redraw when required or when too many regions have been drawn.
+        """
+        with self.profiler.stage('render'):
+            update = self.image.get_dirty_visualization(self.alpha)
+        if update is None or len(self.drawn_patches) >= _MAX_PATCHES:
+            self.update_mask_image()
+            return
+        (y, x), region = update
+        if not region.size:
+            return
+        scale_y = self.canv_h / self.graph_shape[0]
+        scale_x = self.canv_w / self.graph_shape[1]
+        with self.profiler.stage('resize'):
+            image = Image.fromarray(region).resize(
+                (max(1, round(region.shape[1] * scale_x)),
+                 max(1, round(region.shape[0] * scale_y))),
+                Image.NEAREST)
+        with self.profiler.stage('encode'):
+            data = image_to_bytes(image)
+        with self.profiler.stage('draw_figure'):
+            self.drawn_patches.append(self.window['-IMAGE-'].draw_image(
+                data=data, location=(x, y)))
+
+    def update_info(self):
+        """Updates the name, position and checked status texts."""
         self.window['-NAME-'].update(
             'Current image: ' + self.image.name
             + '\tScore: ' + str(self.image.score)
@@ -199,9 +364,28 @@ class GUI:
         )
         self.window['-CHECKED-'].set_checked(self.dataset.is_image_checked())
         self.window['-CHECKBOX-'].update(self.dataset.is_image_checked())
-        # Set original image
-        data = image_to_bytes(self.dataset.get_original_image())
-        self.window['-ORIGINAL-'].update(data=data)
+
+    def update_original_image(self):
+        """Shows the original image, or hides it if the dataset has no
+        originals. Encoded images are cached, so each one is only read
+        and encoded once.
+        """
+        cur = self.dataset.cur
+        data = self._original_cache.get(cur)
+        if data is None:
+            with self.profiler.stage('original_load'):
+                image = self.dataset.get_original_image()
+            if image is None:
+                self.window['-ORIGINAL-'].update(visible=False)
+                return
+            with self.profiler.stage('encode'):
+                data = image_to_bytes(image)
+            self._original_cache[cur] = data
+            if len(self._original_cache) > _ORIGINAL_CACHE_SIZE:
+                self._original_cache.popitem(last=False)
+        else:
+            self._original_cache.move_to_end(cur)
+        self.window['-ORIGINAL-'].update(data=data, visible=True)
 
     def get_skips(self):
         d = {'-SKIP0-': 0, '-SKIP1-': 1, '-SKIP2-': 2}
@@ -214,29 +398,31 @@ class GUI:
     def next(self):
         skip = self.get_skips()
         skip_checked = self.window['-SKIPC-'].get()
-        self.image = self.dataset.next(skip, skip_checked)
+        with self.profiler.stage('dataset'):
+            self.image = self.dataset.next(skip, skip_checked)
         self.update_image()
 
     def previous(self):
         skip = self.get_skips()
         skip_checked = self.window['-SKIPC-'].get()
-        self.image = self.dataset.previous(skip, skip_checked)
+        with self.profiler.stage('dataset'):
+            self.image = self.dataset.previous(skip, skip_checked)
         self.update_image()
 
     def update_alpha(self, value):
         self.alpha = value
-        self.update_image()
+        self.update_mask_image()
 
     def check_status(self, scores: list = None):
         return self.dataset.check_status(scores)
 
     def undo(self):
         self.image.undo()
-        self.update_image()
+        self.update_mask_region()
 
     def redo(self):
         self.image.redo()
-        self.update_image()
+        self.update_mask_region()
 
     def toggle_mode(self):
         self.draw_mode = not self.draw_mode
@@ -248,22 +434,43 @@ class GUI:
             self.window['Erase'].update(disabled=True)
 
     def click_image(self, coords):
-        """Draw or erase on the mask. Coords are (x, y)."""
-        radius = self.window['-RADIUS-'].get()
+        """Queue a point of the current stroke. Coords are (x, y). The
+        stroke is drawn by flush_stroke once no more events are queued.
+        """
+        if coords[0] is None or coords[1] is None:
+            return
         if self.next_draw_saves:
             self.next_draw_saves = False
             self.image.save_state()
-        if self.draw_mode:
-            self.image.draw_on_mask((coords[1], coords[0]), radius)
-        else:
-            self.image.erase_on_mask((coords[1], coords[0]), radius)
-        self.update_image()
+        self.pending_stroke.append((coords[1], coords[0]))
+
+    def flush_stroke(self):
+        """Draw or erase the queued stroke points on the mask as a single
+        continuous stroke, joined to the previously drawn point.
+        """
+        if not self.pending_stroke:
+            return
+        points = self.pending_stroke
+        if self.last_stroke_point is not None:
+            points = [self.last_stroke_point] + points
+        radius = self.window['-RADIUS-'].get()
+        brush = self.window['-BRUSH-'].get()
+        with self.profiler.stage('stroke'):
+            if self.draw_mode:
+                self.image.draw_stroke(points, radius, brush)
+            else:
+                self.image.erase_stroke(points, radius, brush)
+        self.last_stroke_point = points[-1]
+        self.pending_stroke = []
+        self.update_mask_region()
 
     def mouse_up(self):
         """Release the mouse button, which means a drawing ended."""
         self.next_draw_saves = True
+        self.last_stroke_point = None
         if self.window['-AUTO-'].get():
-            self.dataset.save(checked=False, to_disk=False)
+            with self.profiler.stage('dataset'):
+                self.dataset.save(checked=False, to_disk=False)
 
     def wheel_radius(self, event):
         """Incr. or decr. drawing radius after a MouseWheel event."""
@@ -276,7 +483,7 @@ class GUI:
     def reset_mask(self):
         """Resets the current mask to its original state."""
         self.dataset.reset_mask()
-        self.update_image()
+        self.update_mask_image()
         self.mouse_up()
 
     def save(self, from_exit=False):
@@ -285,22 +492,41 @@ class GUI:
         behavior is deprecated.
         """
         if from_exit:  # Not from button press
-            self.dataset.save(checked=False, to_disk=True)
+            self.dataset.close()
             return
         # From button press
-        if not self.debug_mode:
-            self.dataset.save(checked=False, to_disk=True)
-        else:
-            self.dataset.save(to_disk=False)
+        with self.profiler.stage('dataset'):
+            if not self.debug_mode:
+                self.dataset.save(checked=False, to_disk=True)
+            else:
+                self.dataset.save(to_disk=False)
+        if self.debug_mode:
             print('[DEBUG] Save triggered.')
-        self.update_image()
-        # Update remaining images number
+        self.update_info()
+        self.update_progress()
+
+    def update_progress(self):
+        """Updates the remaining images number and the finished scores.
+        """
         self.window['-REMAINING-'].update('{} remaining'.format(
             self.dataset.get_remaining_images()))
         # Check and display if any image types are finished
         fnshd = [str(i) for i in range(3) if self.check_status([i])]
         if fnshd:
             self.window['-FINISHED-'].update('FINISHED: ' + ','.join(fnshd))
+        else:
+            self.window['-FINISHED-'].update('')
+
+    def update_latency_panel(self):
+        """Shows the latency percentiles in the latency panel, at most
+        once every _LATENCY_PANEL_PERIOD seconds. Only when profiling.
+        """
+        now = time.perf_counter()
+        if (not self.profiler.enabled
+                or now - self._latency_shown < _LATENCY_PANEL_PERIOD):
+            return
+        self._latency_shown = now
+        self.window['-LATENCY-'].update(self.profiler.summary())
 
     def update_running_timer(self):
         """Updates the displayed timer when a timer has been started.
@@ -348,25 +574,44 @@ class GUI:
         else:
             checked = True
             self.window['-CHECKBOX-'].update(True)
-        self.dataset.set_checked(checked)
-        # Update remaining images number
-        self.window['-REMAINING-'].update('{} remaining'.format(
-            self.dataset.get_remaining_images()))
-        # Check and display if any image types are finished
-        fnshd = [str(i) for i in range(3) if self.check_status([i])]
-        if fnshd:
-            self.window['-FINISHED-'].update('FINISHED: ' + ','.join(fnshd))
-        self.update_image()
+        with self.profiler.stage('dataset'):
+            self.dataset.set_checked(checked)
+        self.update_progress()
+        self.update_info()
         self.update_timer_elements()
 
 
-def main(debug):
-    gui = GUI(IrisDataset(), debug_mode=debug)
+def main(debug, profile=False, trace_file=None, checkpoint_every=None):
+    """Runs the GUI. If profile is True, the handling time of each event
+    and its stages is shown in a latency panel. If trace_file is given,
+    they are also written to it on exit. If checkpoint_every is given,
+    changes are written to disk at least every checkpoint_every seconds.
+    """
+    profiler = LatencyProfiler(enabled=profile or trace_file is not None)
+    dataset = IrisDataset(keep_history=True,
+                          checkpoint_every=checkpoint_every)
+    gui = GUI(dataset, debug_mode=debug, profiler=profiler)
     while True:
-        event, values = gui.window.read(timeout=1000)
+        # Drag events are queued until no more events are pending
+        timeout = 0 if gui.pending_stroke else 1000
+        profiler.end_event()
+        event, values = gui.window.read(timeout=timeout)
+        if event not in ('-IMAGE-', sg.WIN_CLOSED) and gui.pending_stroke:
+            # Drawing the queued points is the cost of the drag events
+            profiler.start_event('-IMAGE-')
+            gui.flush_stroke()
+            profiler.end_event()
+        if event not in ('__TIMEOUT__', '-IMAGE-'):
+            profiler.start_event(event)
         gui.update_running_timer()
+        gui.update_latency_panel()
+        dataset.checkpoint()
         if event == sg.WIN_CLOSED:
             gui.save(from_exit=True)
+            profiler.end_event()
+            if trace_file is not None:
+                profiler.dump(trace_file)
+                print(profiler.summary())
             break
         # Draw column
         elif event in ('Draw', 'Erase', '-IMAGE-+RIGHT'):
@@ -420,4 +665,13 @@ def main(debug):
 
 
 if __name__ == '__main__':
-    main(debug=False)
+    parser = argparse.ArgumentParser(description='Mask Fixer')
+    parser.add_argument('--profile', action='store_true',
+                        help='Show a panel with event latencies')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Write event latencies to FILE on exit')
+    parser.add_argument('--checkpoint', type=float, metavar='SECONDS',
+                        help='Write changes to disk every SECONDS')
+    args = parser.parse_args()
+    main(debug=False, profile=args.profile, trace_file=args.trace,
+         checkpoint_every=args.checkpoint)
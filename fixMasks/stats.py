@@ -0,0 +1,163 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .iris import (DatasetRegistry, MaskStore, atomic_write,
+                   load_journal_updates)
+
+_STATS_CHUNK_SIZE = 1024  # Rows compared at a time
+_STATS_SOURCE = '.source.json'  # Suffix of the report's source stamp
+# Number of set bits of every byte, for counting pixels on packed rows
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype='uint16')
+STATS_COLUMNS = ('dataset', 'filename', 'score', 'checked', 'old_pixels',
+                 'new_pixels', 'added', 'removed', 'iou', 'old_occlusion',
+                 'occlusion')
+
+
+def count_pixels(packed: np.ndarray) -> np.ndarray:
+    """Returns the number of masked pixels of each row of a (N, bytes)
+    stack of bit-packed masks.
+    """
+    return _POPCOUNT[packed].sum(axis=1, dtype='int64')
+
+
+def compare_packed_masks(old: np.ndarray, new: np.ndarray,
+                         n_pixels) -> dict:
+    """Compares two (N, bytes) stacks of bit-packed masks row by row.
+    n_pixels is the number of pixels of the masks, or an (N,) array of
+    the pixels of each row.
+    Returns a dict of (N,) arrays with the masked pixels of each mask,
+    the pixels added and removed, the IoU (1 if both masks are empty)
+    and the fraction of occluded pixels of each mask.
+    """
+    old_pixels = count_pixels(old)
+    new_pixels = count_pixels(new)
+    added = count_pixels(new & ~old)
+    removed = count_pixels(old & ~new)
+    intersection = old_pixels - removed
+    union = new_pixels + removed
+    iou = np.divide(intersection, union, out=np.ones(len(old)),
+                    where=union != 0)
+    return {'old_pixels': old_pixels, 'new_pixels': new_pixels,
+            'added': added, 'removed': removed, 'iou': iou,
+            'old_occlusion': old_pixels / n_pixels,
+            'occlusion': new_pixels / n_pixels}
+
+
+def _source_stamp(*files) -> dict:
+    stamp = {}
+    for file in files:
+        if not Path(file).exists():
+            stamp[str(file)] = None
+            continue
+        stat = Path(file).stat()
+        stamp[str(file)] = [stat.st_size, stat.st_mtime_ns]
+    return stamp
+
+
+def compute_mask_stats(npz_file='new_masks.npz',
+                       csv_file='check_masks_full.csv',
+                       orig_shape=(80, 480),
+                       report_file=None,
+                       chunk_size=_STATS_CHUNK_SIZE,
+                       registry=None) -> pd.DataFrame:
+    """Compares the new masks in the .npz file against the original
+    masks of the datasets, in a single streaming pass. Returns a DF
+    with STATS_COLUMNS and the index of the .csv. Rows that have not
+    been checked nor edited keep their original mask. Rows not found
+    in the datasets are skipped with a warning. Rows saved to the
+    journal of the .npz file but not yet compacted into it are read
+    from the journal. Datasets are read from the registry, which
+    defaults to DatasetRegistry.load(orig_shape).
+
+    If report_file is given, the DF is written to it as a .csv,
+    together with a stamp of the .npz, journal and .csv files it was
+    computed from. Later calls load the report instead, while those
+    files are unchanged.
+    """
+    if report_file is not None:
+        report_file = Path(report_file)
+        source_file = report_file.with_name(report_file.name + _STATS_SOURCE)
+        stamp = _source_stamp(npz_file, Path(npz_file).with_suffix(
+            '.journal'), csv_file)
+        if report_file.exists() and source_file.exists():
+            with open(source_file) as f:
+                if json.load(f) == stamp:
+                    return pd.read_csv(report_file, index_col=0,
+                                       float_precision='round_trip')
+    data = registry if registry is not None else \
+        DatasetRegistry.load(orig_shape)
+    df = pd.read_csv(csv_file, index_col=0)
+    data.check(df.dataset)
+    updates = load_journal_updates(npz_file)
+    for row, (_, checked, score) in updates.items():
+        df.loc[row, 'checked'] = checked
+        df.loc[row, 'score'] = score
+    n_pixels = {key: int(np.prod(data.shape(key)))
+                for key in df.dataset.unique()}
+    results = []
+    saved = MaskStore.read_info(npz_file)['saved']
+    masks = {row: update[0] for row, update in updates.items()}
+    for start, new in MaskStore.iter_chunks(npz_file, chunk_size, masks):
+        chunk = df.iloc[start:start + new.shape[0]]
+        if saved is None:  # Files without saved flags
+            chunk_saved = new.any(axis=1)
+        else:
+            chunk_saved = saved[start:start + new.shape[0]].copy()
+        chunk_saved[[row - start for row in masks
+                     if start <= row < start + new.shape[0]]] = True
+        found = np.array([row.filename in data.index(row.dataset)
+                          for row in chunk.itertuples()], dtype=bool)
+        for filename in chunk.filename[~found]:
+            print(f'[WARNING] {filename} not found.')
+        chunk, new, chunk_saved = chunk[found], new[found], chunk_saved[found]
+        # Rows of smaller datasets use the first pixels of the .npz rows
+        old = np.zeros_like(new)
+        for eye, rows in chunk.groupby('dataset').indices.items():
+            idx = [data.index(eye)[f] for f in chunk.filename.iloc[rows]]
+            packed = np.packbits(data[eye]['masks'][idx, :] != 0, axis=1)
+            old[rows, :packed.shape[1]] = packed
+        # Rows never saved keep their original mask
+        unsaved = ~(chunk_saved | chunk.checked.to_numpy(dtype=bool))
+        new = np.where(unsaved[:, np.newaxis], old, new)
+        chunk_pixels = chunk.dataset.map(n_pixels).to_numpy()
+        stats = pd.DataFrame(compare_packed_masks(old, new, chunk_pixels),
+                             index=chunk.index)
+        results.append(pd.concat(
+            [chunk[['dataset', 'filename', 'score', 'checked']], stats],
+            axis=1))
+    if results:
+        report = pd.concat(results)
+    else:
+        report = pd.DataFrame(columns=list(STATS_COLUMNS))
+    if report_file is not None:
+        report.to_csv(report_file)
+        atomic_write(source_file, lambda f: json.dump(stamp, f), mode='w')
+    return report
+
+
+def summarize_mask_stats(report: pd.DataFrame,
+                         by=('dataset', 'score')) -> pd.DataFrame:
+    """Aggregates the per-image report of compute_mask_stats by the
+    given columns. Returns the number of images, checked and changed
+    images, the mean and minimum IoU, the total pixels added and
+    removed, and the mean occlusion before and after.
+    """
+    report = report.assign(changed=(report.added + report.removed) > 0)
+    return report.groupby(list(by)).agg(
+        n_images=('filename', 'size'),
+        n_checked=('checked', 'sum'),
+        n_changed=('changed', 'sum'),
+        mean_iou=('iou', 'mean'),
+        min_iou=('iou', 'min'),
+        added=('added', 'sum'),
+        removed=('removed', 'sum'),
+        old_occlusion=('old_occlusion', 'mean'),
+        occlusion=('occlusion', 'mean'))
+
+
+def most_changed(report: pd.DataFrame, n=20) -> pd.DataFrame:
+    """Returns the n images of the report with the lowest IoU."""
+    return report.nsmallest(n, 'iou')
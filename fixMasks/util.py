@@ -1,48 +1,113 @@
+import hashlib
+import io
+import json
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from itertools import product
-from os import chdir, getcwd
+from os import chdir, cpu_count, getcwd
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 from PIL import Image
 from scipy.io import loadmat
-from skimage.measure import block_reduce
-from tqdm import trange
+from tqdm import tqdm
 
-from .iris import load_raw_dataset, IrisImage
+from .iris import (atomic_write, DatasetRegistry, load_journal_updates,
+                   MaskStore)
 
 
 EYES = ('left', 'right')
 # [0] must always be iris , [1] masks [2] visual(ization),
-# [3] visual_old
-SUBFOLDERS = ('iris', 'masks', 'visual', 'visual_old')
+# [3] visual_old [4] visual_diff
+SUBFOLDERS = ('iris', 'masks', 'visual', 'visual_old', 'visual_diff')
+MASK_COLOR = (0, 255, 0)  # Mask pixels in overlays
+REMOVED_COLOR = (255, 0, 0)  # Pixels only in the old mask in diff overlays
+ADDED_COLOR = (0, 0, 255)  # Pixels only in the new mask in diff overlays
+_EXPORT_CHUNK_SIZE = 64  # Rows exported by each task of the process pool
+_EXPORT_MAX_MEMORY = 2**30  # Bytes used by the chunks being exported
+_EXPORT_BYTES_PER_PIXEL = 12  # Estimated bytes used per pixel of a row
+_RESIZE_BATCH_SIZE = 16  # Rows resized together by the export pipeline
+_EXPORT_MANIFEST = 'export_manifest.json'
+_SHARDS_INDEX = 'shards.json'
+_SHARD_SIZE = 16384  # Rows per shard in packed exports
+_SHARD_KEYS = ('iris', 'masks', 'labels', 'filenames')
+
+# Data loaded once by each export worker process
+_export_state = {}
+
+
+def block_ratio(to_size: tuple, from_size=(80, 480)) -> tuple:
+    """Returns the (rows, cols) size of the blocks that reduce from_size
+    into to_size. Both ratios must be integers.
+    """
+    if from_size[0] % to_size[0]:
+        raise ValueError('Vertical ratio not supported')
+    if from_size[1] % to_size[1]:
+        raise ValueError('Horizontal ratio not supported')
+    return from_size[0] // to_size[0], from_size[1] // to_size[1]
+
+
+def batch_block_reduce(stack: np.ndarray, to_size: tuple,
+                       from_size=(80, 480), reduce='max') -> np.ndarray:
+    """Reduces every flattened image of an (N, M) stack from from_size
+    to to_size at once, taking the maximum or the mean of each block.
+    Returns an (N, to_size[0]*to_size[1]) stack.
+    """
+    bh, bw = block_ratio(to_size, from_size)
+    blocks = stack.reshape((stack.shape[0], to_size[0], bh, to_size[1], bw))
+    if reduce == 'max':
+        out = blocks.max(axis=(2, 4))
+    elif reduce == 'mean':
+        out = blocks.mean(axis=(2, 4))
+    else:
+        raise ValueError('Unknown reduction: ' + str(reduce))
+    return out.reshape((stack.shape[0], -1))
+
+
+def build_pyramid(stack: np.ndarray, to_sizes: list, from_size=(80, 480),
+                  reduce='max') -> dict:
+    """Reduces an (N, M) stack of flattened images to every size in
+    to_sizes. Each size is reduced from the smallest size already
+    computed that is an integer multiple of it, so a 240x40, 120x20,
+    ... pyramid is built in one pass. Mean reductions are kept as floats
+    until the end and rounded to the dtype of the stack.
+    Returns a {size: stack} dict.
+    """
+    levels = {tuple(from_size): stack}
+    work_stack = stack if reduce == 'max' else stack.astype(float)
+    work_levels = {tuple(from_size): work_stack}
+    for size in sorted(set(map(tuple, to_sizes)), key=lambda x: -x[0]*x[1]):
+        if size in levels:
+            continue
+        sources = [s for s in work_levels
+                   if s[0] % size[0] == 0 and s[1] % size[1] == 0]
+        source = min(sources, key=lambda x: x[0]*x[1])
+        reduced = batch_block_reduce(work_levels[source], size, source,
+                                     reduce)
+        work_levels[size] = reduced
+        if reduce == 'mean':
+            reduced = np.rint(reduced).astype(stack.dtype)
+        levels[size] = reduced
+    return {tuple(size): levels[tuple(size)] for size in to_sizes}
 
 
 def ready_iris(input_iris: np.ndarray, to_size: tuple, from_size=(80, 480)):
-    """Reshapes, [resizes] and converts iris to PIL.Image."""
-    iris = input_iris.reshape(from_size)
-    out_iris = Image.fromarray(iris)
+    """Reshapes, [resizes] and converts iris to PIL.Image. Resizing
+    averages each block of pixels.
+    """
+    iris = input_iris.reshape((1, -1))
     if to_size != from_size:
-        out_iris = out_iris.resize(to_size[::-1])
-    return out_iris
+        iris = build_pyramid(iris, [to_size], from_size, 'mean')[to_size]
+    return Image.fromarray(iris.reshape(to_size))
 
 
 def resize_mask(input_mask: np.ndarray, to_size: tuple, from_size=(80, 480)):
-    if to_size[0]*2 == from_size[0]:
-        h = 2
-    elif to_size[0]*4 == from_size[0]:
-        h = 4
-    else:
-        raise ValueError('Vertical ratio not supported')
-    if to_size[1]*2 == from_size[1]:
-        w = 2
-    elif to_size[1]*4 == from_size[1]:
-        w = 4
-    else:
-        raise ValueError('Horizontal ratio not supported')
-
-    out_mask = block_reduce(input_mask, (h, w), np.max)
-    return out_mask.astype('uint8') * 255
+    """Resizes a mask by any integer ratio, keeping each block masked if
+    any of its pixels is masked.
+    """
+    out_mask = batch_block_reduce(input_mask.reshape((1, -1)), to_size,
+                                  from_size, 'max')
+    return out_mask.reshape(to_size).astype('uint8') * 255
 
 
 def ready_mask(input_mask: np.ndarray, to_size: tuple, from_size=(80, 480)):
@@ -60,8 +125,302 @@ def ready_mask(input_mask: np.ndarray, to_size: tuple, from_size=(80, 480)):
 
 def generate_visualization(iris: np.ndarray, mask: np.ndarray, shape: tuple):
     """Generates a visualization of the masked iris."""
-    iris_image = IrisImage(iris, mask, shape + (1,))
-    return iris_image.get_visualization(1.0)
+    return render_overlays(iris[np.newaxis], mask[np.newaxis], shape)[0]
+
+
+def _blend_labels(irises: np.ndarray, labels: np.ndarray, palette,
+                  alpha: float):
+    """Blends the colors of the palette over a (N, h, w) stack of
+    irises. labels is a (N, h, w) array of indices into the palette,
+    with 0 leaving the iris untouched. Returns a (N, h, w, 3) stack.
+    """
+    irises = irises[..., np.newaxis]
+    colors = np.asarray(palette)[labels]
+    blended = ((1 - alpha)*irises + alpha*colors).astype(irises.dtype)
+    return np.where(labels[..., np.newaxis] != 0, blended, irises)
+
+
+def render_overlays(irises: np.ndarray, masks: np.ndarray, shape: tuple,
+                    alpha=1.0):
+    """Visualizes each mask of a (N, h*w) stack over its iris, in one
+    broadcast blend. Returns a (N, h, w, 3) stack, matching
+    IrisImage.get_visualization for each row.
+    """
+    n = irises.shape[0]
+    labels = (masks.reshape((n,) + tuple(shape)) != 0).astype('uint8')
+    return _blend_labels(irises.reshape((n,) + tuple(shape)), labels,
+                         [(0, 0, 0), MASK_COLOR], alpha)
+
+
+def render_diff_overlays(irises: np.ndarray, old_masks: np.ndarray,
+                         new_masks: np.ndarray, shape: tuple, alpha=1.0):
+    """Visualizes the old and new masks of a (N, h*w) stack side by
+    side, in one broadcast blend. Pixels in both masks are drawn with
+    MASK_COLOR, pixels removed from the old mask with REMOVED_COLOR on
+    the left, and pixels added to the new mask with ADDED_COLOR on the
+    right. Returns a (N, h, 2*w, 3) stack.
+    """
+    n = irises.shape[0]
+    shape = (n,) + tuple(shape)
+    irises = irises.reshape(shape)
+    old_masks = old_masks.reshape(shape) != 0
+    new_masks = new_masks.reshape(shape) != 0
+    old_labels = old_masks * (1 + ~new_masks)
+    new_labels = new_masks * (1 + 2*~old_masks)
+    labels = np.concatenate([old_labels, new_labels], axis=2)
+    return _blend_labels(np.concatenate([irises, irises], axis=2), labels,
+                         [(0, 0, 0), MASK_COLOR, REMOVED_COLOR, ADDED_COLOR],
+                         alpha)
+
+
+def _load_export_data(csv_file, registry: DatasetRegistry, states=None):
+    """Returns the DF of an export, checking that all of its datasets
+    are in the registry. The {row: (checked, score)} states replace
+    those of the DF.
+    """
+    df = pd.read_csv(csv_file, index_col=0)
+    registry.check(df.dataset)
+    for row, (checked, score) in (states or {}).items():
+        df.loc[row, 'checked'] = checked
+        df.loc[row, 'score'] = score
+    return df
+
+
+def _init_export_worker(csv_file, datasets, states, labels, manifest):
+    """Loads the DF and the registry of datasets, as given by
+    DatasetRegistry.datasets, once in each export worker process.
+    Datasets are memory-mapped when first accessed. Masks are not
+    loaded, they are streamed to the workers with each chunk.
+    """
+    _export_state['data'] = DatasetRegistry(datasets)
+    _export_state['df'] = _load_export_data(csv_file, _export_state['data'],
+                                            states)
+    _export_state['labels'] = labels
+    _export_state['manifest'] = manifest
+
+
+def load_export_manifest(out_folder) -> dict:
+    """Returns the {output image: content hash} manifest of a previous
+    export to out_folder, or an empty dict.
+    """
+    path = Path(out_folder) / _EXPORT_MANIFEST
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_export_manifest(out_folder, manifest: dict):
+    """Atomically writes the manifest of an export to out_folder."""
+    atomic_write(Path(out_folder) / _EXPORT_MANIFEST,
+                 lambda f: json.dump(manifest, f, sort_keys=True), 'w')
+
+
+def _row_digest(iris, mask, old_mask, checked, options) -> str:
+    """Returns a hash of everything that determines the exported images
+    of a row.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(options).encode())
+    digest.update(b'1' if checked else b'0')
+    for array in (iris, np.packbits(mask != 0), np.packbits(old_mask != 0)):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def _is_exported(out_folder, key, digest, subfolders) -> bool:
+    """Returns True if the manifest entry of an output image matches
+    the digest and all of its files exist.
+    """
+    if _export_state['manifest'].get(key) != digest:
+        return False
+    dataset_dir, name = key.split('/')
+    return all((out_folder / dataset_dir / sf / (name + '.bmp')).exists()
+               for sf in subfolders)
+
+
+def _read_stage(start, end, packed, export_args, stats):
+    """First stage of the export pipeline. Yields (row, iris, mask,
+    old_mask) for the rows in [start, end) of the DF whose outputs are
+    not up to date. packed holds the new masks of these rows, or is
+    None if the old masks are exported. Warnings, new manifest entries
+    and the number of rows to export are recorded in stats.
+    """
+    (out_folder, out_shapes, datasets, use_old_mask, gen_old_visualization,
+     gen_new_visualization, gen_diff_visualization) = export_args
+    df = _export_state['df']
+    options = (use_old_mask, gen_old_visualization, gen_new_visualization,
+               gen_diff_visualization)
+    subfolders = [sf for sf, gen in zip(SUBFOLDERS, (
+        True, True, gen_new_visualization, gen_old_visualization,
+        gen_diff_visualization)) if gen]
+    for i in range(start, end):
+        row = df.loc[i]
+        cur_data_dict = _export_state['data'][row.dataset]
+        # Find current image on data
+        idx = cur_data_dict['index'].get(row.filename)
+        if idx is None:
+            stats['warnings'].append(
+                f'[WARNING] {row.filename}.bmp not found.')
+            continue
+        # Check if label corresponds to .mat
+        _y_data = cur_data_dict['y'][idx]  # DEBUG
+        _y_mat = _export_state['labels'][row.filename]  # DEBUG
+        if _y_data != _y_mat:  # DEBUG
+            raise ValueError('Wrong label!')  # DEBUG
+        iris = np.array(cur_data_dict['x'][idx, :])
+        old_mask = np.array(cur_data_dict['masks'][idx, :])
+        if use_old_mask:
+            mask = old_mask
+        else:
+            mask = np.unpackbits(packed[i - start], count=iris.shape[0])
+        shape = _export_state['data'].shape(row.dataset)
+        digest = _row_digest(iris, mask, old_mask, row.checked,
+                             (shape,) + options)
+        keys = [row.dataset + '_' + dataset + '/' + row.filename
+                for dataset in datasets]
+        if all(_is_exported(out_folder, key, digest, subfolders)
+               for key in keys):
+            continue
+        stats['manifest'].update((key, digest) for key in keys)
+        stats['exported'] += 1
+        yield row, iris, mask, old_mask
+
+
+def _resize_stage(records, export_args, batch_size=_RESIZE_BATCH_SIZE):
+    """Second stage of the export pipeline. Groups up to batch_size
+    consecutive records of datasets of the same shape and resizes their
+    irises and masks to every output shape at once. Yields (rows,
+    irises, masks, old_masks), with the last three being {shape: stack}
+    dicts.
+    """
+    out_shapes = export_args[1]
+    gen_old_visualization = export_args[4] or export_args[6]
+    batch = []
+    batch_shape = None
+    for record in records:
+        shape = _export_state['data'].shape(record[0].dataset)
+        if batch and shape != batch_shape:
+            yield _resize_batch(batch, out_shapes, batch_shape,
+                                gen_old_visualization)
+            batch = []
+        batch.append(record)
+        batch_shape = shape
+        if len(batch) < batch_size:
+            continue
+        yield _resize_batch(batch, out_shapes, batch_shape,
+                            gen_old_visualization)
+        batch = []
+    if batch:
+        yield _resize_batch(batch, out_shapes, batch_shape,
+                            gen_old_visualization)
+
+
+def _resize_batch(batch, out_shapes, orig_shape, gen_old_visualization):
+    rows, irises, masks, old_masks = zip(*batch)
+    irises = build_pyramid(np.stack(irises), out_shapes, orig_shape, 'mean')
+    masks = build_pyramid(np.stack(masks) != 0, out_shapes, orig_shape)
+    if gen_old_visualization:
+        old_masks = build_pyramid(np.stack(old_masks) != 0, out_shapes,
+                                  orig_shape)
+    return rows, irises, masks, old_masks
+
+
+def _encode_bmp(array: np.ndarray) -> bytes:
+    with io.BytesIO() as output:
+        Image.fromarray(array).save(output, format='BMP')
+        return output.getvalue()
+
+
+def _encode_stage(batches, export_args):
+    """Third stage of the export pipeline. Yields (path, BMP bytes) for
+    every output image of the resized batches. Visualizations are
+    rendered for the whole batch at once.
+    """
+    (out_folder, out_shapes, datasets, use_old_mask, gen_old_visualization,
+     gen_new_visualization, gen_diff_visualization) = export_args
+    for rows, irises, masks, old_masks in batches:
+        for resize_shape, dataset in zip(map(tuple, out_shapes), datasets):
+            cur_irises = irises[resize_shape]
+            cur_masks = masks[resize_shape]
+            outputs = {
+                SUBFOLDERS[1]: cur_masks.astype('uint8') * 255,
+                SUBFOLDERS[0]: cur_irises}
+            if gen_new_visualization:
+                outputs[SUBFOLDERS[2]] = render_overlays(
+                    cur_irises, cur_masks, resize_shape)
+            if gen_old_visualization:
+                outputs[SUBFOLDERS[3]] = render_overlays(
+                    cur_irises, old_masks[resize_shape], resize_shape)
+            if gen_diff_visualization:
+                outputs[SUBFOLDERS[4]] = render_diff_overlays(
+                    cur_irises, old_masks[resize_shape], cur_masks,
+                    resize_shape)
+            for k, row in enumerate(rows):
+                cur_dir = out_folder / (row.dataset + '_' + dataset)
+                cur_name = row.filename + '.bmp'
+                for sf, images in outputs.items():
+                    image = images[k]
+                    if image.ndim == 1:
+                        image = image.reshape(resize_shape)
+                    yield cur_dir / sf / cur_name, _encode_bmp(image)
+
+
+def _export_chunk(start, end, packed, export_args):
+    """Exports the rows in [start, end) of the DF for every output
+    shape, through the read, resize, encode and write stages. Each
+    stage pulls from the previous one, so only one batch is held at a
+    time. Returns the number of rows, the number of exported rows, the
+    list of warnings and the new manifest entries.
+    """
+    stats = {'warnings': [], 'manifest': {}, 'exported': 0}
+    records = _read_stage(start, end, packed, export_args, stats)
+    batches = _resize_stage(records, export_args)
+    for path, data in _encode_stage(batches, export_args):
+        with open(path, 'wb') as f:
+            f.write(data)
+    return end - start, stats['exported'], stats['warnings'], \
+        stats['manifest']
+
+
+def _row_chunks(npz_file, n_rows, chunk_size, use_old_mask, updates):
+    """Yields (start, end, packed) for consecutive chunks of rows, with
+    the packed masks of the chunk streamed from the .npz file (None if
+    use_old_mask is True). The masks of the rows in updates, as returned
+    by load_journal_updates, replace those of the file.
+    """
+    if use_old_mask:
+        for start in range(0, n_rows, chunk_size):
+            yield start, min(start + chunk_size, n_rows), None
+        return
+    masks = {row: update[0] for row, update in updates.items()}
+    for start, packed in MaskStore.iter_chunks(npz_file, chunk_size, masks):
+        yield start, start + packed.shape[0], packed
+
+
+def _export_results(chunks, init_args, export_args, n_workers,
+                    max_in_flight):
+    """Exports the chunks of rows, in a pool of n_workers processes, and
+    yields the result of each chunk as it is completed. Chunks are read
+    lazily and at most max_in_flight of them are queued or being
+    exported at a time.
+    """
+    if n_workers == 1:
+        _init_export_worker(*init_args)
+        for chunk in chunks:
+            yield _export_chunk(*chunk, export_args)
+        return
+    with ProcessPoolExecutor(n_workers, initializer=_init_export_worker,
+                             initargs=init_args) as executor:
+        pending = set()
+        for chunk in chunks:
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(_export_chunk, *chunk, export_args))
+        for future in wait(pending).done:
+            yield future.result()
 
 
 def export_masks_as_images(out_folder: str,
@@ -71,7 +430,13 @@ def export_masks_as_images(out_folder: str,
                            orig_shape=(80, 480),
                            use_old_mask=False,
                            gen_old_visualization=False,
-                           gen_new_visualization=False):
+                           gen_new_visualization=False,
+                           gen_diff_visualization=False,
+                           n_workers=None,
+                           chunk_size=_EXPORT_CHUNK_SIZE,
+                           incremental=True,
+                           max_memory=_EXPORT_MAX_MEMORY,
+                           registry=None):
     """Exports the masks in the .npz file as images, together with the
     iris image. The name for each mask and their sub-folders are
     obtained from the .csv.
@@ -100,35 +465,69 @@ def export_masks_as_images(out_folder: str,
         generated.
 
     npz_file : str, optional
-        Path of the .npz file containing the new masks array.
+        Path of the .npz file containing the new masks array. Rows saved
+        to its journal (the file with a .journal suffix) but not yet
+        compacted into it are read from the journal.
 
     csv_file : str, optional
         Path of the .csv file listing the images in the new masks array.
 
     orig_shape : tuple of int, optional
         Original shape of the masks in array, in (rows, cols) format.
+        Only used when there is no registry nor datasets.json, to find
+        the left and right datasets of that shape.
+
+    gen_diff_visualization : bool, optional
+        If True, side by side visualizations of the old and new masks
+        are generated in a visual_diff sub-folder, with the removed and
+        added pixels highlighted in different colors.
+
+    n_workers : int, optional
+        Number of worker processes. Defaults to the number of CPUs. If
+        1, the export runs in the current process.
+
+    chunk_size : int, optional
+        Number of rows exported by each task given to the workers.
+
+    incremental : bool, optional
+        If True, only the rows whose masks, iris, checked status or
+        export options changed since the last export to out_folder, or
+        whose output files are missing, are exported. The content hash
+        of each output is kept in out_folder/export_manifest.json.
+
+    max_memory : int, optional
+        Approximate number of bytes used by the chunks being exported.
+        Limits the chunk size and the number of chunks in flight, so
+        datasets larger than the available memory can be exported.
+
+    registry : DatasetRegistry, optional
+        Registry of the datasets in the .csv, with the shape of each
+        one. Defaults to DatasetRegistry.load(orig_shape). Every output
+        shape must evenly divide the shape of every dataset.
+
+    Returns the number of rows that were exported.
     """
     old_dir = None
     if Path.cwd().name == 'fixMasks' and Path('fixMasks').exists():
         old_dir = getcwd()
         chdir('fixMasks')
-    # Determine datasets from the original shape and out shapes
-    orig_dataset = 'x'.join(str(i) for i in orig_shape[::-1])
+    if n_workers is None:
+        n_workers = cpu_count() or 1
+    if registry is None:
+        registry = DatasetRegistry.load(orig_shape)
+    # Determine datasets from the out shapes
     datasets = tuple('x'.join(str(i) for i in shape[::-1])
                      for shape in out_shapes)
-    # Load data
-    masks = np.load(npz_file)['masks']
-    df = pd.read_csv(csv_file, index_col=0)
+    updates = load_journal_updates(npz_file)
+    states = {row: update[1:] for row, update in updates.items()}
+    df = _load_export_data(csv_file, registry)
     n_masks = len(df)
-    data_dict = {eye: load_raw_dataset(eye + '_' + orig_dataset)
-                 for eye in ('left', 'right')}
     # _labels is for checking that the labels I have on MATLAB are the
     # same as the ones on labels.mat as well as on the dataset .mats
     _labels = loadmat('../data/labels.mat')['labels']  # DEBUG
     _labels = {i[0][0]: i[1][0][0] for i in _labels}  # DEBUG
-    _diff_labels = 0  # DEBUG
     # Generate out folders
-    out_folder = Path(out_folder)
+    out_folder = Path(out_folder).absolute()
     out_folder.mkdir(exist_ok=True, parents=True)
     for f, dataset in product(df.dataset.unique(), datasets):
         dataset_dir = out_folder / (f + '_' + dataset)
@@ -136,62 +535,201 @@ def export_masks_as_images(out_folder: str,
         for sf in SUBFOLDERS:
             sub_folder = dataset_dir / sf
             sub_folder.mkdir(exist_ok=True)
+    # Limit the memory used by the chunks, sized for the largest dataset
+    row_bytes = _EXPORT_BYTES_PER_PIXEL * max(
+        int(np.prod(registry.shape(key))) for key in df.dataset.unique())
+    chunk_size = max(1, min(chunk_size,
+                            max_memory // (row_bytes * n_workers)))
+    max_in_flight = max(1, max_memory // (row_bytes * chunk_size))
     # Generate images
-    for shape_idx in range(len(out_shapes)):
-        resize_shape = out_shapes[shape_idx]
-        dataset = datasets[shape_idx]
-        print('Generating ' + dataset + ' dataset.')
-        for i in trange(n_masks, unit='masks'):
-            # Initialize current
-            row = df.loc[i]
-            cur_dir = out_folder / (row.dataset + '_' + dataset)
-            iris_dir = cur_dir / SUBFOLDERS[0]
-            mask_dir = cur_dir / SUBFOLDERS[1]
-            vis_dir = cur_dir / SUBFOLDERS[2]
-            old_vis_dir = cur_dir / SUBFOLDERS[3]
-            cur_name = row.filename + '.bmp'
-            cur_mask = masks[i, :]
-            cur_data_dict = data_dict[row.dataset]
-            # Find current image on data
-            idx = np.where(cur_data_dict['list'] == row.filename)[0]
-            if not len(idx):
-                print(f'[WARNING] {cur_name} not found.')
+    manifest = load_export_manifest(out_folder) if incremental else {}
+    init_args = (csv_file, registry.datasets, states, _labels, manifest)
+    export_args = (out_folder, out_shapes, datasets, use_old_mask,
+                   gen_old_visualization, gen_new_visualization,
+                   gen_diff_visualization)
+    chunks = _row_chunks(npz_file, n_masks, chunk_size, use_old_mask,
+                         updates)
+    print('Generating ' + ', '.join(datasets) + ' datasets.')
+    n_exported = 0
+    with tqdm(total=n_masks, unit='masks') as progress:
+        for n_rows, n_chunk_exported, warnings, chunk_manifest in \
+                _export_results(chunks, init_args, export_args, n_workers,
+                                max_in_flight):
+            progress.update(n_rows)
+            n_exported += n_chunk_exported
+            manifest.update(chunk_manifest)
+            for warning in warnings:
+                print(warning)
+    save_export_manifest(out_folder, manifest)
+    print('{} masks exported, {} already up to date.'.format(
+        n_exported, n_masks - n_exported))
+
+    if old_dir is not None:
+        chdir(old_dir)
+    return n_exported
+
+
+def _write_shards(dataset_dir: Path, rows: list, shape: tuple,
+                  shard_size: int):
+    """Creates the (empty) memory-mapped shard files of a packed export
+    for the supplied DF rows, removing any previous index. Returns a
+    list of (start, end, arrays) per shard, with the arrays opened for
+    writing. The index is written by _write_shards_index once the
+    shards are filled.
+    """
+    dataset_dir.mkdir(exist_ok=True, parents=True)
+    index_file = dataset_dir / _SHARDS_INDEX
+    if index_file.exists():
+        index_file.unlink()
+    n_pixels = shape[0] * shape[1]
+    name_len = max([len(row.filename) for row in rows] + [1])
+    shards = []
+    for n, start in enumerate(range(0, len(rows), shard_size)):
+        end = min(start + shard_size, len(rows))
+        arrays = {}
+        for key, dtype, cols in (('iris', 'uint8', (n_pixels,)),
+                                 ('masks', 'uint8', (-(-n_pixels // 8),)),
+                                 ('labels', 'uint8', ()),
+                                 ('filenames', '<U{}'.format(name_len), ())):
+            arrays[key] = np.lib.format.open_memmap(
+                dataset_dir / '{}_{:03n}.npy'.format(key, n), mode='w+',
+                dtype=dtype, shape=(end - start,) + cols)
+        shards.append((start, end, arrays))
+    return shards
+
+
+def _write_shards_index(dataset_dir: Path, shards: list, shape: tuple):
+    """Flushes the shards of a packed export and then atomically writes
+    their index, so load_shards never reads an incomplete export.
+    """
+    index = {'shape': list(shape), 'n_rows': 0, 'shards': []}
+    for n, (start, end, arrays) in enumerate(shards):
+        for array in arrays.values():
+            array.flush()
+        index['shards'].append({'id': n, 'start': start, 'end': end})
+        index['n_rows'] = end
+    atomic_write(dataset_dir / _SHARDS_INDEX,
+                 lambda f: json.dump(index, f), 'w')
+
+
+def export_masks_as_shards(out_folder: str,
+                           out_shapes: list,
+                           npz_file='new_masks.npz',
+                           csv_file='check_masks_full.csv',
+                           orig_shape=(80, 480),
+                           use_old_mask=False,
+                           shard_size=_SHARD_SIZE,
+                           chunk_size=_EXPORT_CHUNK_SIZE,
+                           registry=None):
+    """Exports the masks in the .npz file, together with the irises,
+    labels and filenames, as a few contiguous .npy shards per dataset
+    and output shape, which can be memory-mapped with load_shards. The
+    structure is as follows:
+        out_folder/
+        ├── left_[dataset]/
+        │   ├── shards.json
+        │   ├── iris_000.npy       (N, h*w) uint8 irises
+        │   ├── masks_000.npy      (N, h*w/8) bit-packed masks
+        │   ├── labels_000.npy     (N,) labels
+        │   ├── filenames_000.npy  (N,) filenames
+        │   └── ....
+        └── right_[dataset]/
+            └── ....
+    Parameters are the same as in export_masks_as_images. Each shard
+    holds up to shard_size rows.
+    """
+    old_dir = None
+    if Path.cwd().name == 'fixMasks' and Path('fixMasks').exists():
+        old_dir = getcwd()
+        chdir('fixMasks')
+    data = registry if registry is not None else \
+        DatasetRegistry.load(orig_shape)
+    datasets = tuple('x'.join(str(i) for i in shape[::-1])
+                     for shape in out_shapes)
+    updates = load_journal_updates(npz_file)
+    df = _load_export_data(
+        csv_file, data, {row: update[1:] for row, update in updates.items()})
+    out_folder = Path(out_folder).absolute()
+    # Position of each DF row in the shards of its eye
+    positions = {}
+    rows = {}
+    for i, row in df.iterrows():
+        if row.filename not in data.index(row.dataset):
+            print(f'[WARNING] {row.filename} not found.')
+            continue
+        eye_rows = rows.setdefault(row.dataset, [])
+        positions[i] = (row.dataset, len(eye_rows))
+        eye_rows.append(row)
+    dataset_dirs = {(eye, shape): out_folder / (eye + '_' + dataset)
+                    for eye in rows
+                    for shape, dataset in zip(map(tuple, out_shapes),
+                                              datasets)}
+    shards = {(eye, shape): _write_shards(dataset_dir, rows[eye], shape,
+                                          shard_size)
+              for (eye, shape), dataset_dir in dataset_dirs.items()}
+    print('Generating {} shards.'.format(', '.join(datasets)))
+    # Masks are streamed in a single pass over the .npz file
+    chunks = _row_chunks(npz_file, len(df), chunk_size, use_old_mask,
+                         updates)
+    n_chunks = -(-len(df) // chunk_size)
+    for start, end, packed in tqdm(chunks, total=n_chunks, unit='chunks'):
+        for eye in rows:
+            eye_data = data[eye]
+            eye_shape = data.shape(eye)
+            chunk = [i for i in range(start, end)
+                     if positions.get(i, (None,))[0] == eye]
+            if not chunk:
                 continue
-            iris = cur_data_dict['x'][idx[0], :]
-            old_mask = cur_data_dict['masks'][idx[0], :]
+            idx = np.array([eye_data['index'][df.filename[i]]
+                            for i in chunk])
             if use_old_mask:
-                cur_mask = old_mask
-            # Check if label corresponds to .mat
-            _y_data = cur_data_dict['y'][idx]  # DEBUG
-            _y_mat = _labels[row.filename]  # DEBUG
-            if _y_data != _y_mat:  # DEBUG
-                _diff_labels += 1  # DEBUG
-                raise ValueError('Wrong label!')  # DEBUG
-            # Ready mask and save images
-            cur_mask = ready_mask(cur_mask, to_size=resize_shape,
-                                  from_size=orig_shape)
-            mask_img = Image.fromarray(cur_mask)
-            mask_img.save(mask_dir / cur_name)
-            # Ready iris and save images
-            iris_img = ready_iris(iris, to_size=resize_shape,
-                                  from_size=orig_shape)
-            iris_img.save(iris_dir / cur_name)
-            # Generate and save visualization
-            if gen_new_visualization:
-                vis = generate_visualization(np.array(iris_img).flatten(),
-                                             cur_mask.flatten()/255,
-                                             resize_shape)
-                vis_img = Image.fromarray(vis)
-                vis_img.save(vis_dir / cur_name)
-            # Generate and save old mask visualization
-            if gen_old_visualization:
-                old_mask = ready_mask(old_mask, to_size=resize_shape,
-                                      from_size=orig_shape)
-                old_vis = generate_visualization(np.array(iris_img).flatten(),
-                                                 old_mask.flatten()/255,
-                                                 resize_shape)
-                old_vis_img = Image.fromarray(old_vis)
-                old_vis_img.save(old_vis_dir / cur_name)
+                masks = eye_data['masks'][idx, :] != 0
+            else:
+                masks = np.unpackbits(packed[np.array(chunk) - start], axis=1,
+                                      count=eye_data['x'].shape[1]) != 0
+            irises = build_pyramid(eye_data['x'][idx, :], out_shapes,
+                                   eye_shape, 'mean')
+            masks = build_pyramid(masks, out_shapes, eye_shape)
+            # Rows of one eye in a chunk have contiguous positions
+            pos = positions[chunk[0]][1]
+            for shape in map(tuple, out_shapes):
+                for shard_start, shard_end, arrays in shards[eye, shape]:
+                    lo = max(pos, shard_start)
+                    hi = min(pos + len(chunk), shard_end)
+                    if lo >= hi:
+                        continue
+                    src = slice(lo - pos, hi - pos)
+                    dst = slice(lo - shard_start, hi - shard_start)
+                    arrays['iris'][dst] = irises[shape][src]
+                    arrays['masks'][dst] = np.packbits(masks[shape][src],
+                                                       axis=1)
+                    arrays['labels'][dst] = eye_data['y'][idx[src]].ravel()
+                    arrays['filenames'][dst] = df.filename[chunk[src]]
+    # Indexes go last, so an interrupted export is never loaded
+    for (eye, shape), dataset_dir in dataset_dirs.items():
+        _write_shards_index(dataset_dir, shards[eye, shape], shape)
 
     if old_dir is not None:
         chdir(old_dir)
+
+
+def load_shards(dataset_dir) -> list:
+    """Memory-maps the shards of a packed export of one dataset and
+    shape. Returns a list with a dict of 'iris', 'masks' (bit-packed),
+    'labels' and 'filenames' arrays per shard. Use unpack_shard_masks
+    to unpack the masks.
+    """
+    dataset_dir = Path(dataset_dir)
+    with open(dataset_dir / _SHARDS_INDEX) as f:
+        index = json.load(f)
+    return [{key: np.load(dataset_dir / '{}_{:03n}.npy'.format(
+        key, shard['id']), mmap_mode='r') for key in _SHARD_KEYS}
+        for shard in index['shards']]
+
+
+def unpack_shard_masks(packed: np.ndarray, shape: tuple) -> np.ndarray:
+    """Unpacks an (N, h*w/8) array of packed masks into an (N, h, w)
+    array of 0s and 1s.
+    """
+    masks = np.unpackbits(packed, axis=1, count=shape[0] * shape[1])
+    return masks.reshape((-1,) + tuple(shape))
@@ -0,0 +1,125 @@
+import unittest
+from functools import partial
+
+import numpy as np
+
+from fixMasks.batch_ops import (apply_batch, closing, dilate, erode, opening,
+                                remove_small_components, reset_to_original,
+                                select_rows)
+
+from .synthetic_case import SyntheticDatasetCase
+
+
+class TestMorphology(unittest.TestCase):
+    def setUp(self) -> None:
+        self.masks = np.zeros((2, 7, 12), dtype=bool)
+        self.masks[0, 3, 5] = True
+        self.masks[1, 2:5, 3:8] = True
+        self.masks = self.masks.reshape((2, -1))
+
+    def test_dilate_erode(self):
+        dilated = dilate(self.masks, (7, 12), 1).reshape((2, 7, 12))
+        self.assertEqual(dilated[0].sum(), 5)
+        self.assertTrue(dilated[0, 2, 5] and dilated[0, 3, 6])
+        # Masks are dilated independently
+        self.assertEqual(dilated[1].sum(), 15 + 2*5 + 2*3)
+        eroded = erode(self.masks, (7, 12), 1).reshape((2, 7, 12))
+        self.assertEqual(eroded[0].sum(), 0)
+        self.assertEqual(eroded[1].sum(), 3)
+
+    def test_wrap(self):
+        masks = np.zeros((1, 5, 8), dtype=bool)
+        masks[0, 2, 0] = True
+        dilated = dilate(masks.reshape((1, -1)), (5, 8), 1)
+        self.assertTrue(dilated.reshape((5, 8))[2, 7])
+        dilated = dilate(masks.reshape((1, -1)), (5, 8), 1, wrap=False)
+        self.assertFalse(dilated.reshape((5, 8))[2, 7])
+
+    def test_opening_closing(self):
+        opened = opening(self.masks, (7, 12), 1)
+        self.assertFalse(opened[0].any())
+        self.assertTrue(np.all(opened[1] <= self.masks[1]))
+        gap = self.masks.reshape((2, 7, 12)).copy()
+        gap[1, 3, 5] = False
+        closed = closing(gap.reshape((2, -1)), (7, 12), 1)
+        self.assertTrue(closed.reshape((2, 7, 12))[1, 3, 5])
+
+    def test_remove_small_components(self):
+        masks = np.zeros((2, 6, 10), dtype=bool)
+        masks[0, 1, 1] = masks[0, 4, 4] = True
+        masks[0, 2:4, 6:9] = True
+        # Crosses the left and right edges
+        masks[1, 2, [0, 1, 9]] = True
+        masks = masks.reshape((2, -1))
+        cleaned = remove_small_components(masks, (6, 10), 3)
+        self.assertEqual(cleaned[0].sum(), 6)
+        self.assertTrue(np.all(cleaned[1] == masks[1]))
+        cleaned = remove_small_components(masks, (6, 10), 3, wrap=False)
+        self.assertFalse(cleaned[1].any())
+        with self.assertRaises(ValueError):
+            remove_small_components(masks, (6, 10), 3, connectivity=6)
+
+
+class TestBatchOperations(SyntheticDatasetCase):
+    n_images = 8
+    checked_fraction = 0.5
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.dataset = self.open()
+
+    def tearDown(self) -> None:
+        self.dataset.close()
+        super().tearDown()
+
+    def reopened_masks(self):
+        """Drops the dataset without closing it, only stopping its
+        threads, as a script exiting without close() would, and returns
+        the masks read back from disk by a new IrisDataset.
+        """
+        self.dataset.prefetcher.shutdown()
+        self.dataset._writer.shutdown()
+        self.dataset.journal.close()
+        self.dataset = self.open()
+        return self.dataset.get_masks(np.arange(self.dataset.n_images))
+
+    def test_select_rows(self):
+        df = self.dataset.df
+        rows = select_rows(self.dataset, scores=[1], checked=False,
+                           datasets=['left'])
+        expected = df.index[(df.score == 1) & ~df.checked
+                            & (df.dataset == 'left')]
+        self.assertEqual(list(rows), list(expected))
+        self.assertEqual(list(select_rows(self.dataset)),
+                         list(range(len(df))))
+
+    def test_apply_batch(self):
+        operation = partial(dilate, shape=self.shape)
+        rows = np.arange(self.dataset.n_images)
+        original = self.dataset.get_masks(rows)
+        report = apply_batch(self.dataset, operation, dry_run=True)
+        self.assertTrue((report.added > 0).any())
+        self.assertTrue(np.all(self.dataset.get_masks(rows) == original))
+        report = apply_batch(self.dataset, operation)
+        self.assertFalse(self.dataset._writer.pending())
+        expected = operation(original)
+        self.assertTrue(np.all(report.added == (expected & ~original).sum(
+            axis=1)))
+        self.assertTrue(np.all(self.dataset.get_masks(rows) == expected))
+        # Written without closing the dataset
+        self.assertTrue(np.all(self.reopened_masks() == expected))
+        report = reset_to_original(self.dataset)
+        original = self.dataset.get_original_masks(rows)
+        self.assertTrue(np.all(report.removed == (expected & ~original).sum(
+            axis=1)))
+        self.assertTrue(np.all(self.reopened_masks() == original))
+
+    def test_empty_mask(self):
+        df = self.dataset.df
+        row = df.index[~df.checked & (self.dataset.get_masks(
+            df.index).sum(axis=1) > 0)][0]
+        report = apply_batch(self.dataset, np.zeros_like, rows=[row])
+        self.assertGreater(report.removed[row], 0)
+        self.assertFalse(self.dataset.get_masks([row]).any())
+        self.assertFalse(self.reopened_masks()[row].any())
+        self.assertFalse(self.dataset.df.checked[row])
@@ -1,8 +1,23 @@
+import json
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+from itertools import product
+from pathlib import Path
 
 import numpy as np
+import pandas as pd
+from scipy.io import savemat
 
-from fixMasks.iris import IrisImage
+from fixMasks.iris import (DatasetRegistry, ImagePrefetcher, IrisImage,
+                           MaskJournal, MaskStore, NavigationIndex,
+                           ProgressTracker, SaveWorker, StateStore,
+                           get_brush_kernel, index_images_list,
+                           load_raw_dataset)
+
+from .synthetic_case import SyntheticDatasetCase
 
 
 class TestIrisImage(unittest.TestCase):
@@ -36,3 +51,544 @@ class TestIrisImage(unittest.TestCase):
         self.image_a.undo()
         self.image_a.redo()
         self.assertTrue(np.all(expected.flatten() == self.image_a.mask))
+
+    def test_undo_stroke(self):
+        self.image_a.save_state()
+        self.image_a.draw_on_mask((0, 0), 1)
+        self.image_a.draw_on_mask((2, 2), 1)
+        self.image_a.save_state()
+        self.image_a.erase_on_mask((1, 1), 1)
+        self.image_a.undo()
+        expected = np.array([[1, 1, 0], [1, 0, 1], [0, 1, 1]])
+        self.assertTrue(np.all(expected.flatten() == self.image_a.mask))
+        self.image_a.undo()
+        self.assertTrue(np.all(self.image_a.mask == 0))
+        indices, before, after = self.image_a.redo_stack[-1]
+        self.assertEqual(indices.shape, (6,))
+
+    def test_history(self):
+        self.image_a.draw_on_mask((1, 1), 1)
+        history = self.image_a.get_history()
+        image = IrisImage(self.image_a.data, self.image_a.mask.copy(),
+                          (3, 3, 1))
+        image.set_history(history)
+        image.undo()
+        self.assertTrue(np.all(image.mask == 0))
+
+    def test_draw_clipped(self):
+        expected = np.array([[1, 1, 0], [1, 1, 0], [0, 0, 0]])
+        self.image_a.draw_on_mask((0, 0), 1, brush='square')
+        self.assertTrue(np.all(expected.flatten() == self.image_a.mask))
+
+    def test_stroke(self):
+        image = IrisImage(np.zeros(200), np.zeros(200), (10, 20, 1))
+        image.draw_stroke([(5, 0), (5, 19)], 1)
+        mask = image.mask.reshape((10, 20))
+        self.assertTrue(np.all(mask[4:7, :] == 1))
+        self.assertEqual(mask.sum(), 60)
+        image.erase_stroke([(0, 10), (9, 10)], 1, brush='square')
+        self.assertTrue(np.all(mask[:, 9:12] == 0))
+
+    def test_brush_kernels(self):
+        self.assertEqual(get_brush_kernel(2).sum(), 13)
+        self.assertEqual(get_brush_kernel(2, 'square').shape, (5, 5))
+        self.assertEqual(get_brush_kernel(1, 'ellipse').shape, (3, 13))
+        with self.assertRaises(ValueError):
+            get_brush_kernel(1, 'star')
+
+    def test_dirty_visualization(self):
+        iris = np.random.randint(0, 256, (20, 30)).astype('uint8')
+        image = IrisImage(iris.flatten(), np.zeros(600), (20, 30, 1))
+        self.assertIsNone(image.get_dirty_visualization(0.5))
+        image.get_visualization(0.5)
+        image.draw_on_mask((0, 10), 2)
+        (y, x), region = image.get_dirty_visualization(0.5)
+        self.assertEqual((y, x), (0, 8))
+        self.assertEqual(region.shape, (3, 5, 3))
+        expected = image.get_visualization(0.5)
+        self.assertTrue(np.all(region == expected[:3, 8:13]))
+        _, region = image.get_dirty_visualization(0.5)
+        self.assertEqual(region.size, 0)
+
+
+class TestMaskStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dense = np.random.randint(0, 2, (5, 13)).astype(float)
+        self.store = MaskStore.from_dense(self.dense)
+
+    def test_get_row(self):
+        for i in range(5):
+            self.assertTrue(np.all(self.dense[i] == self.store.get_row(i)))
+
+    def test_set_row(self):
+        self.store.set_row(2, np.ones(13))
+        self.assertTrue(np.all(self.store.get_row(2) == 1))
+        self.assertTrue(np.all(self.store.get_row(1) == self.dense[1]))
+        self.store.set_row(2, np.zeros(13))
+        self.assertFalse(self.store.has_mask(2))
+        self.assertTrue(self.store.saved[2])
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'masks.npz'
+            self.store.save(path)
+            loaded = MaskStore.load(path, 5)
+            self.assertTrue(np.all(loaded.packed == self.store.packed))
+            # Legacy dense format
+            np.savez_compressed(path, masks=self.dense)
+            loaded = MaskStore.load(path)
+            self.assertTrue(np.all(loaded.packed == self.store.packed))
+            # Saved flags of empty rows
+            self.store.set_row(0, np.zeros(13))
+            self.store.save(path)
+            loaded = MaskStore.load(path)
+            self.assertTrue(loaded.saved[0])
+            self.assertTrue(np.all(loaded.saved == self.store.saved))
+
+    def test_load_legacy(self):
+        # Legacy files spanning several chunks are packed as they stream
+        dense = np.random.randint(0, 2, (150, 13)).astype(float)
+        dense[3] = 0
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'masks.npz'
+            np.savez_compressed(path, masks=dense)
+            loaded = MaskStore.load(path, 150)
+        expected = MaskStore.from_dense(dense)
+        self.assertTrue(np.all(loaded.packed == expected.packed))
+        self.assertTrue(np.all(loaded.saved == dense.any(axis=1)))
+
+    def test_iter_chunks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'masks.npz'
+            for save in (self.store.save,
+                         lambda p: np.savez_compressed(p, masks=self.dense)):
+                save(path)
+                chunks = list(MaskStore.iter_chunks(path, 2))
+                self.assertEqual([start for start, _ in chunks], [0, 2, 4])
+                packed = np.concatenate([rows for _, rows in chunks])
+                self.assertTrue(np.all(packed == self.store.packed))
+            updated = np.full(2, 255, dtype='uint8')
+            chunks = MaskStore.iter_chunks(path, 2, {3: updated})
+            packed = np.concatenate([rows for _, rows in chunks])
+            self.assertTrue(np.all(packed[3] == updated))
+            self.assertTrue(np.all(packed[4] == self.store.packed[4]))
+
+    def test_read_info(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'masks.npz'
+            self.store.save(path, journal_seq=7)
+            info = MaskStore.read_info(path)
+            self.assertTrue(np.all(info.pop('saved') == self.store.saved))
+            self.assertEqual(info, {'n_rows': 5, 'n_pixels': 13,
+                                    'journal_seq': 7})
+            np.savez_compressed(path, masks=self.dense)
+            self.assertEqual(MaskStore.read_info(path), {
+                'n_rows': 5, 'n_pixels': 13, 'journal_seq': 0,
+                'saved': None})
+
+
+class TestMaskJournal(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'masks.journal'
+        self.journal = MaskJournal(self.path, 4)
+        self.rows = np.random.randint(0, 256, (3, 4)).astype('uint8')
+        for i in range(3):
+            self.journal.append(i, self.rows[i], i % 2 == 0, i)
+        self.journal.close()
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_replay(self):
+        records = list(MaskJournal(self.path, 4).replay())
+        self.assertEqual([r[0] for r in records], [1, 2, 3])
+        self.assertEqual([r[2] for r in records], [True, False, True])
+        for i, record in enumerate(records):
+            self.assertTrue(np.all(record[4] == self.rows[i]))
+
+    def test_corrupt_tail(self):
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.path.stat().st_size - 2)
+        self.assertEqual(len(MaskJournal(self.path, 4)), 2)
+
+    def test_append_after_corrupt_tail(self):
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.path.stat().st_size - 3)
+        journal = MaskJournal(self.path, 4)
+        seq = journal.append_many([(7, self.rows[0], True, 1),
+                                   (8, self.rows[1], False, 2)])
+        journal.close()
+        self.assertEqual(seq, 4)
+        records = list(MaskJournal(self.path, 4).replay())
+        self.assertEqual([r[0] for r in records], [1, 2, 3, 4])
+        self.assertEqual([r[1] for r in records], [0, 1, 7, 8])
+
+    def test_truncate(self):
+        self.journal.truncate(2)
+        records = list(self.journal.replay())
+        self.assertEqual([r[0] for r in records], [3])
+        self.journal.truncate(3)
+        self.assertFalse(self.path.exists())
+
+    def test_append_many(self):
+        journal = MaskJournal(self.path, 4)
+        list(journal.replay())
+        seq = journal.append_many([(7, self.rows[0], True, 1),
+                                   (8, self.rows[1], False, 2)])
+        journal.close()
+        self.assertEqual(seq, 5)
+        records = list(MaskJournal(self.path, 4).replay())
+        self.assertEqual([r[1] for r in records], [0, 1, 2, 7, 8])
+
+    def test_updates(self):
+        journal = MaskJournal(self.path, 4)
+        list(journal.replay())
+        journal.append(0, self.rows[2], False, 5)
+        journal.close()
+        updates = journal.updates(after_seq=1)
+        self.assertEqual(sorted(updates), [0, 1, 2])
+        packed_row, checked, score = updates[0]
+        self.assertTrue(np.all(packed_row == self.rows[2]))
+        self.assertEqual((checked, score), (False, 5))
+
+
+class TestSaveWorker(unittest.TestCase):
+    def setUp(self) -> None:
+        self.written = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+        def write_rows(rows):
+            self.gate.wait()
+            self.written.append(('rows', dict(rows)))
+
+        def write_snapshot(snapshot):
+            self.gate.wait()
+            self.written.append(('snapshot', snapshot))
+
+        def write_states(states):
+            self.written.append(('states', dict(states)))
+        self.worker = SaveWorker(write_rows, write_snapshot, write_states)
+
+    def test_coalesce(self):
+        self.gate.clear()
+        self.worker.put_rows({0: 'a'})
+        while not self.worker.pending() or self.worker._rows:
+            pass  # Wait until the first write has started
+        self.worker.put_rows({1: 'b', 2: 'c'})
+        self.worker.put_rows({1: 'd'})
+        self.gate.set()
+        self.worker.drain()
+        self.assertEqual(self.written, [('rows', {0: 'a'}),
+                                        ('rows', {1: 'd', 2: 'c'})])
+        self.assertFalse(self.worker.pending())
+
+    def test_snapshot(self):
+        self.gate.clear()
+        self.worker.put_rows({0: 'a'})
+        while self.worker._rows:
+            pass
+        self.worker.put_rows({1: 'b'})
+        self.worker.put_states({1: 'b'})
+        self.worker.put_snapshot('s1')
+        self.worker.put_snapshot('s2')
+        self.worker.put_rows({2: 'c'})
+        self.gate.set()
+        self.worker.shutdown()
+        self.assertEqual(self.written, [('rows', {0: 'a'}),
+                                        ('snapshot', 's2'),
+                                        ('rows', {2: 'c'}),
+                                        ('states', {1: 'b'})])
+
+    def test_error(self):
+        def fail(rows):
+            raise OSError('disk full')
+        worker = SaveWorker(fail, None)
+        worker.put_rows({0: 'a'})
+        with self.assertRaises(OSError):
+            worker.drain()
+        worker.shutdown()
+
+    def test_exit(self):
+        # Queued writes survive exiting without shutdown
+        script = (
+            'import sys, time\n'
+            'from fixMasks.iris import SaveWorker\n'
+            'def write(rows):\n'
+            '    time.sleep(0.2)\n'
+            '    open(sys.argv[1], "w").write(str(sorted(rows)))\n'
+            'SaveWorker(write, None).put_rows({1: "a", 2: "b"})\n')
+        with tempfile.TemporaryDirectory() as tmp:
+            out = Path(tmp) / 'rows.txt'
+            subprocess.run([sys.executable, '-c', script, str(out)],
+                           check=True, cwd=Path(__file__).parents[1])
+            self.assertEqual(out.read_text(), '[1, 2]')
+
+
+class TestStateStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.csv = Path(self.tmp.name) / 'check.csv'
+        self.df = pd.DataFrame({
+            'dataset': ['left', 'left', 'right', 'right'],
+            'filename': ['a', 'b', 'c', 'd'],
+            'score': [0, 1, 2, 1],
+            'checked': [True, False, False, True]})
+        self.df.to_csv(self.csv)
+        self.store = StateStore.import_csv(self.csv,
+                                           Path(self.tmp.name) / 'db')
+
+    def tearDown(self) -> None:
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_load_export(self):
+        self.assertTrue(self.store.load().equals(self.df))
+        self.store.export_csv(self.csv)
+        self.assertTrue(pd.read_csv(self.csv, index_col=0).equals(self.df))
+
+    def test_rows(self):
+        self.assertEqual(list(self.store.rows()), [0, 1, 2, 3])
+        self.assertEqual(list(self.store.rows(checked=True)), [0, 3])
+        self.assertEqual(list(self.store.rows(scores=[1, 2])), [1, 2, 3])
+        self.assertEqual(list(self.store.rows(checked=False,
+                                              datasets=['right'])), [2])
+
+    def test_set_state(self):
+        self.store.set_state(1, True, 2)
+        self.store.set_states({2: (True, 0), 3: (False, 1)})
+        df = self.store.load()
+        self.assertEqual(list(df.checked), [True, True, True, False])
+        self.assertEqual(list(df.score), [0, 2, 0, 1])
+        # Other connections see each committed row
+        other = StateStore(self.store.path)
+        self.assertEqual(list(other.rows(checked=True)), [0, 1, 2])
+        other.close()
+
+
+class TestIndexImagesList(unittest.TestCase):
+    def test_index(self):
+        index = index_images_list(np.array(['a', 'b', 'c']))
+        self.assertEqual(index, {'a': 0, 'b': 1, 'c': 2})
+
+    def test_duplicates(self):
+        with self.assertRaises(ValueError):
+            index_images_list(np.array(['a', 'b', 'a']))
+
+
+class TestLoadRawDataset(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        images_list = np.zeros((4, 1), dtype=[('name', 'O')])
+        for i in range(4):
+            images_list[i, 0]['name'] = '0000{}d{}_img'.format(i, i)
+        self.x = np.random.randint(0, 256, (4, 6)).astype('uint8')
+        savemat(str(self.root / 'test_6x1.mat'), {
+            'dataArray': self.x,
+            'labelArray': np.array([[0], [1], [1], [0]]),
+            'maskArray': (self.x > 128).astype('uint8'),
+            'imagesList': images_list
+        })
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_load(self):
+        dataset = load_raw_dataset('test_6x1', self.root)
+        self.assertIsInstance(dataset['x'], np.memmap)
+        self.assertTrue(np.all(dataset['x'] == self.x))
+        self.assertEqual(dataset['index']['00002d2'], 2)
+        self.assertTrue((self.root / 'cache' / 'test_6x1').exists())
+        # Loading again must use the cache
+        (self.root / 'test_6x1.mat').unlink()
+        dataset = load_raw_dataset('test_6x1', self.root)
+        self.assertTrue(np.all(dataset['masks'] == (self.x > 128)))
+
+
+class TestDatasetRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        for name, shape in (('a', (1, 6)), ('b', (2, 4))):
+            images_list = np.zeros((3, 1), dtype=[('name', 'O')])
+            for i in range(3):
+                images_list[i, 0]['name'] = '{}{}_img'.format(name, i)
+            x = np.random.randint(0, 256, (3, shape[0] * shape[1]))
+            savemat(str(self.root / (name + '.mat')), {
+                'dataArray': x.astype('uint8'),
+                'labelArray': np.zeros((3, 1)),
+                'maskArray': (x > 128).astype('uint8'),
+                'imagesList': images_list
+            })
+        with open(self.root / 'datasets.json', 'w') as f:
+            json.dump({'a': {'mat': 'a.mat', 'shape': [1, 6],
+                             'originals': 'orig_a'},
+                       'b': {'mat': 'b.mat', 'shape': [2, 4]}}, f)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_from_config(self):
+        registry = DatasetRegistry.from_config(self.root / 'datasets.json')
+        self.assertEqual(list(registry), ['a', 'b'])
+        self.assertEqual(registry.shape('b'), (2, 4))
+        self.assertEqual(registry.originals('a'), self.root / 'orig_a')
+        self.assertIsNone(registry.originals('b'))
+        with self.assertRaises(ValueError):
+            DatasetRegistry({'c': {'mat': 'c.mat'}})
+
+    def test_default(self):
+        registry = DatasetRegistry.default((8, 48))
+        self.assertEqual(registry.datasets['right']['mat'].name,
+                         'right_48x8.mat')
+        self.assertEqual(registry.shape('left'), (8, 48))
+
+    def test_lazy_open(self):
+        registry = DatasetRegistry.from_config(self.root / 'datasets.json')
+        self.assertEqual(registry.index('b')['b2'], 2)
+        self.assertFalse(registry.is_open('b'))
+        self.assertFalse(registry.is_open('a'))
+        self.assertEqual(registry['a']['index']['a1'], 1)
+        self.assertTrue(registry.is_open('a'))
+        self.assertFalse(registry.is_open('b'))
+
+    def test_eviction(self):
+        registry = DatasetRegistry.from_config(self.root / 'datasets.json',
+                                               memory_budget=0)
+        registry['a']
+        registry['b']
+        # The most recent dataset is kept even over the budget
+        self.assertFalse(registry.is_open('a'))
+        self.assertTrue(registry.is_open('b'))
+        registry.memory_budget = 2**20
+        registry['a']
+        registry['b']
+        registry['a']
+        self.assertTrue(registry.is_open('a') and registry.is_open('b'))
+        self.assertEqual(list(registry._open), ['b', 'a'])
+
+
+class TestImagePrefetcher(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loaded = []
+        self.prefetcher = ImagePrefetcher(self.load, max_items=3)
+
+    def tearDown(self) -> None:
+        self.prefetcher.shutdown()
+
+    def load(self, index):
+        self.loaded.append(index)
+        return index * 10
+
+    def test_get(self):
+        self.prefetcher.prefetch([1, 2])
+        self.assertEqual(self.prefetcher.get(2), 20)
+        self.assertEqual(self.prefetcher.get(1), 10)
+        self.assertIsNone(self.prefetcher.get(3))
+
+    def test_lru(self):
+        self.prefetcher.prefetch([1, 2, 3])
+        self.prefetcher.get(1)
+        self.prefetcher.prefetch([4])
+        self.assertIsNone(self.prefetcher.get(2))
+        self.assertEqual(self.prefetcher.get(1), 10)
+        self.assertEqual(self.prefetcher.get(4), 40)
+
+
+class TestNavigationIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.scores = np.random.randint(0, 3, 50)
+        self.checked = np.random.rand(50) > 0.7
+        self.nav = NavigationIndex(self.scores, self.checked)
+
+    def find(self, start, step, skip, skip_checked):
+        """Reference implementation, walking one image at a time."""
+        for i in range(50):
+            cur = (start + i * step) % 50
+            if self.scores[cur] not in skip and \
+                    not (self.checked[cur] and skip_checked):
+                return cur
+        return None
+
+    def test_find(self):
+        for start, step, skip, skip_checked in product(
+                range(50), (1, -1), ([], [0], [1, 2]), (False, True)):
+            self.assertEqual(self.nav.find(start, step, skip, skip_checked),
+                             self.find(start, step, skip, skip_checked))
+
+    def test_set_checked(self):
+        self.nav.find(0, 1, [1], True)
+        for i in range(0, 50, 3):
+            self.checked[i] = not self.checked[i]
+            self.nav.set_checked(i, self.checked[i])
+        for start in range(50):
+            self.assertEqual(self.nav.find(start, 1, [1], True),
+                             self.find(start, 1, [1], True))
+
+    def test_all_skipped(self):
+        self.assertIsNone(self.nav.find(0, 1, [0, 1, 2], False))
+
+
+class TestProgressTracker(unittest.TestCase):
+    def setUp(self) -> None:
+        datasets = ['left', 'left', 'left', 'right', 'right']
+        scores = [0, 1, 1, 0, 2]
+        checked = [True, False, True, False, True]
+        self.progress = ProgressTracker(datasets, scores, checked)
+
+    def test_counts(self):
+        self.assertEqual(self.progress.n_remaining(), 2)
+        self.assertEqual(self.progress.n_checked(datasets=['left']), 2)
+        self.assertEqual(self.progress.n_remaining(scores=[1]), 1)
+        self.assertTrue(self.progress.is_finished(scores=[2]))
+        self.assertFalse(self.progress.is_finished(scores=[0]))
+
+    def test_set_checked(self):
+        self.progress.set_checked(1, True)
+        self.progress.set_checked(1, True)
+        self.assertTrue(self.progress.is_finished(scores=[1]))
+        self.progress.set_checked(4, False)
+        self.assertEqual(self.progress.n_remaining(), 2)
+        self.assertFalse(self.progress.is_finished(datasets=['right']))
+
+
+class TestIrisDataset(SyntheticDatasetCase):
+    def test_state_store_csv(self):
+        StateStore.import_csv('check_masks_full.csv',
+                              'check_masks.sqlite').close()
+        dataset = self.open()
+        for row in (1, 4):
+            dataset.cur = row
+            dataset.get_irisimage()
+            dataset.set_checked(True)
+        dataset.close()
+        # The CSV read by the export and stats tools is kept up to date
+        df = pd.read_csv('check_masks_full.csv', index_col=0)
+        self.assertEqual(list(df.checked[[1, 4]]), [True, True])
+        self.assertEqual(df.checked.sum(), 2)
+
+    def test_missing_filename(self):
+        df = pd.read_csv('check_masks_full.csv', index_col=0)
+        df.loc[4, 'filename'] = 'missing'
+        df.to_csv('check_masks_full.csv')
+        # Reported when loading, not when the row is visited
+        with self.assertRaises(ValueError):
+            self.open()
+
+    def test_lazy_open(self):
+        dataset = self.open()
+        self.assertFalse(dataset.data.is_open('left'))
+        self.assertFalse(dataset.data.is_open('right'))
+        dataset.cur = 0
+        dataset.get_irisimage()
+        self.assertTrue(dataset.data.is_open('left'))
+        dataset.close()
+
+    def test_no_originals(self):
+        dataset = self.open()
+        dataset.cur = 0
+        dataset.get_irisimage()
+        self.assertIsNone(dataset.get_original_image())
+        dataset.close()
@@ -0,0 +1,79 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from fixMasks.iris import MaskJournal
+from fixMasks.stats import (compare_packed_masks, compute_mask_stats,
+                            count_pixels, most_changed, summarize_mask_stats)
+
+from .synthetic_case import SyntheticDatasetCase
+
+
+class TestMaskStats(unittest.TestCase):
+    def setUp(self) -> None:
+        self.old = np.random.rand(6, 21) > 0.5
+        self.new = np.random.rand(6, 21) > 0.5
+        self.new[0] = self.old[0]
+        self.old[1] = self.new[1] = False
+
+    def test_count_pixels(self):
+        packed = np.packbits(self.old, axis=1)
+        self.assertTrue(np.all(count_pixels(packed) == self.old.sum(axis=1)))
+
+    def test_compare(self):
+        stats = compare_packed_masks(np.packbits(self.old, axis=1),
+                                     np.packbits(self.new, axis=1), 21)
+        old, new = self.old, self.new
+        self.assertTrue(np.all(stats['added'] == (new & ~old).sum(axis=1)))
+        self.assertTrue(np.all(stats['removed'] == (old & ~new).sum(axis=1)))
+        self.assertTrue(np.allclose(stats['occlusion'], new.mean(axis=1)))
+        union = (old | new).sum(axis=1)
+        iou = (old & new).sum(axis=1) / np.maximum(union, 1)
+        self.assertTrue(np.allclose(stats['iou'][2:], iou[2:]))
+        self.assertEqual(list(stats['iou'][:2]), [1, 1])
+
+    def test_summarize(self):
+        stats = compare_packed_masks(np.packbits(self.old, axis=1),
+                                     np.packbits(self.new, axis=1), 21)
+        report = pd.DataFrame({'dataset': ['left'] * 3 + ['right'] * 3,
+                               'filename': list('abcdef'),
+                               'score': [0, 0, 1, 0, 1, 1],
+                               'checked': [True] * 6, **stats})
+        summary = summarize_mask_stats(report)
+        self.assertEqual(list(summary.n_images), [2, 1, 1, 2])
+        self.assertEqual(summary.n_changed.loc['left', 0], 0)
+        self.assertEqual(summary.added.sum(), report.added.sum())
+        worst = most_changed(report, 2)
+        self.assertEqual(list(worst.iou), sorted(report.iou)[:2])
+
+
+class TestComputeMaskStats(SyntheticDatasetCase):
+    n_images = 4
+
+    def test_journal(self):
+        report = compute_mask_stats(orig_shape=(8, 48),
+                                    report_file='report.csv')
+        self.assertEqual(report.added.sum() + report.removed.sum(), 0)
+        # A row saved to the journal but not compacted into the .npz
+        journal = MaskJournal('new_masks.journal', 8 * 48 // 8)
+        journal.append(1, np.full(8 * 48 // 8, 255, dtype='uint8'), True, 2)
+        journal.close()
+        report = compute_mask_stats(orig_shape=(8, 48),
+                                    report_file='report.csv')
+        self.assertEqual(report.new_pixels[1], 8 * 48)
+        self.assertEqual(report.added[1], 8 * 48 - report.old_pixels[1])
+        self.assertTrue(report.checked[1])
+        self.assertEqual(report.score[1], 2)
+
+    def test_registry(self):
+        # Two datasets of different shapes, with names of their own
+        registry, row = self.use_mixed_datasets()
+        df = pd.read_csv('check_masks_full.csv', index_col=0)
+        report = compute_mask_stats(registry=registry)
+        self.assertEqual(list(report.dataset), list(df.dataset))
+        self.assertEqual(report.new_pixels[row], 8 * 24)
+        self.assertEqual(report.occlusion[row], 1)
+        self.assertEqual(report.added[row], 8 * 24 - report.old_pixels[row])
+        others = report.drop(row)
+        self.assertEqual(others.added.sum() + others.removed.sum(), 0)
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.io import loadmat, savemat
+
+from benchmarks.synthetic import EYES, dataset_name, generate_dataset
+from fixMasks.iris import DatasetRegistry, IrisDataset, MaskStore
+
+
+def mat_file(root, eye: str, shape: tuple) -> Path:
+    """Returns the .mat file of a synthetic dataset."""
+    return Path(root) / 'data' / (dataset_name(eye, shape) + '.mat')
+
+
+class SyntheticDatasetCase(unittest.TestCase):
+    """Runs each test from the work folder of a new synthetic dataset of
+    n_images of the given shape, generated in a temporary folder.
+    """
+    n_images = 6
+    shape = (8, 48)
+    checked_fraction = 0.0
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        generate_dataset(self.root, self.n_images, self.shape,
+                         self.checked_fraction)
+        self.old_dir = os.getcwd()
+        os.chdir(self.root / 'work')
+
+    def tearDown(self) -> None:
+        os.chdir(self.old_dir)
+        self.tmp.cleanup()
+
+    def registry_entries(self) -> dict:
+        """Returns the entries of the left and right datasets, as given
+        to DatasetRegistry.
+        """
+        return {eye: {'mat': mat_file(self.root, eye, self.shape),
+                      'shape': self.shape} for eye in EYES}
+
+    def open(self) -> IrisDataset:
+        return IrisDataset(registry=DatasetRegistry(self.registry_entries()))
+
+    def use_mixed_datasets(self):
+        """Renames the datasets to 'od' and 'os', with the 'os' images
+        replaced by those of a second synthetic dataset of half the
+        width, and fills the first pixels of the .npz row of the first
+        'os' row, which are the whole mask of that row. Returns the
+        registry of both datasets and that row.
+        """
+        small_root = self.root / 'small'
+        small_shape = (self.shape[0], self.shape[1] // 2)
+        generate_dataset(small_root, self.n_images, small_shape, seed=1)
+        registry = DatasetRegistry({
+            'od': {'mat': mat_file(self.root, 'left', self.shape),
+                   'shape': self.shape},
+            'os': {'mat': mat_file(small_root, 'right', small_shape),
+                   'shape': small_shape}})
+        small = pd.read_csv(small_root / 'work' / 'check_masks_full.csv',
+                            index_col=0)
+        df = pd.read_csv('check_masks_full.csv', index_col=0)
+        df['dataset'] = df.dataset.map({'left': 'od', 'right': 'os'})
+        df.loc[df.dataset == 'os', 'filename'] = \
+            small.filename[small.dataset == 'right'].values
+        df.to_csv('check_masks_full.csv')
+        labels = [loadmat(folder / 'data' / 'labels.mat')['labels']
+                  for folder in (self.root, small_root)]
+        savemat(self.root / 'data' / 'labels.mat',
+                {'labels': np.concatenate(labels)})
+        row = int(np.flatnonzero(df.dataset == 'os')[0])
+        masks = MaskStore.load('new_masks.npz')
+        masks.set_row(row, np.arange(masks.n_pixels)
+                      < small_shape[0] * small_shape[1])
+        masks.save('new_masks.npz')
+        return registry, row
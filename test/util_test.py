@@ -0,0 +1,213 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from fixMasks.iris import IrisImage, MaskJournal, MaskStore
+from fixMasks.util import (ADDED_COLOR, MASK_COLOR, REMOVED_COLOR,
+                           _write_shards, _write_shards_index,
+                           batch_block_reduce, block_ratio,
+                           build_pyramid, export_masks_as_images,
+                           export_masks_as_shards, load_export_manifest,
+                           load_shards, ready_mask,
+                           render_diff_overlays, render_overlays,
+                           save_export_manifest, unpack_shard_masks)
+
+from .synthetic_case import SyntheticDatasetCase
+
+
+class TestBatchResize(unittest.TestCase):
+    def setUp(self) -> None:
+        self.masks = np.random.rand(5, 8 * 24) > 0.8
+        self.irises = np.random.randint(0, 256, (5, 8 * 24)).astype('uint8')
+
+    def test_block_ratio(self):
+        self.assertEqual(block_ratio((4, 8), (8, 24)), (2, 3))
+        with self.assertRaises(ValueError):
+            block_ratio((3, 8), (8, 24))
+
+    def test_max_reduce(self):
+        reduced = batch_block_reduce(self.masks, (4, 8), (8, 24))
+        for mask, out in zip(self.masks, reduced):
+            expected = mask.reshape((4, 2, 8, 3)).max(axis=(1, 3))
+            self.assertTrue(np.all(out.reshape((4, 8)) == expected))
+
+    def test_ready_mask(self):
+        out = ready_mask(self.masks[0], (2, 6), (8, 24))
+        expected = self.masks[0].reshape((2, 4, 6, 4)).max(axis=(1, 3))
+        self.assertTrue(np.all(out == expected * 255))
+
+    def test_pyramid(self):
+        sizes = [(4, 12), (2, 6), (4, 8), (8, 24)]
+        pyramid = build_pyramid(self.irises, sizes, (8, 24), 'mean')
+        self.assertEqual(list(pyramid), sizes)
+        for size in sizes:
+            expected = batch_block_reduce(self.irises.astype(float), size,
+                                          (8, 24), 'mean')
+            self.assertEqual(pyramid[size].dtype, np.uint8)
+            self.assertTrue(np.all(pyramid[size] == np.rint(expected)))
+        pyramid = build_pyramid(self.masks, sizes, (8, 24))
+        for size in sizes:
+            expected = batch_block_reduce(self.masks, size, (8, 24))
+            self.assertTrue(np.all(pyramid[size] == expected))
+
+
+class TestOverlays(unittest.TestCase):
+    def setUp(self) -> None:
+        self.irises = np.random.randint(0, 256, (4, 6 * 10)).astype('uint8')
+        self.old = np.random.rand(4, 6 * 10) > 0.5
+        self.new = np.random.rand(4, 6 * 10) > 0.5
+
+    def test_overlays(self):
+        for alpha in (1.0, 0.5):
+            overlays = render_overlays(self.irises, self.new, (6, 10), alpha)
+            self.assertEqual(overlays.shape, (4, 6, 10, 3))
+            for iris, mask, out in zip(self.irises, self.new, overlays):
+                image = IrisImage(iris, mask.astype(float), (6, 10, 1))
+                self.assertTrue(np.all(image.get_visualization(alpha) == out))
+
+    def test_diff_overlays(self):
+        diff = render_diff_overlays(self.irises, self.old, self.new, (6, 10))
+        self.assertEqual(diff.shape, (4, 6, 20, 3))
+        old, new = (m.reshape((4, 6, 10)) for m in (self.old, self.new))
+        left, right = diff[:, :, :10], diff[:, :, 10:]
+        self.assertTrue(np.all(left[old & new] == MASK_COLOR))
+        self.assertTrue(np.all(right[old & new] == MASK_COLOR))
+        self.assertTrue(np.all(left[old & ~new] == REMOVED_COLOR))
+        self.assertTrue(np.all(right[new & ~old] == ADDED_COLOR))
+        irises = self.irises.reshape((4, 6, 10))
+        self.assertTrue(np.all(left[~old][:, 0] == irises[~old]))
+        self.assertTrue(np.all(right[~new][:, 0] == irises[~new]))
+
+
+class TestExportManifest(unittest.TestCase):
+    def test_save_load(self):
+        manifest = {'left_240x40/04233d1715': 'a1b2', 'right_240x40/x': 'c3'}
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertEqual(load_export_manifest(tmp), {})
+            save_export_manifest(tmp, manifest)
+            self.assertEqual(load_export_manifest(tmp), manifest)
+
+
+class TestIncrementalExport(SyntheticDatasetCase):
+    checked_fraction = 0.5
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.out = self.root / 'export'
+
+    def export(self):
+        return export_masks_as_images(self.out, [(4, 24)],
+                                      orig_shape=(8, 48), n_workers=1)
+
+    def test_export_twice(self):
+        self.assertEqual(self.export(), 6)
+        self.assertEqual(self.export(), 0)
+        df = pd.read_csv('check_masks_full.csv', index_col=0)
+        # A changed mask
+        masks = MaskStore.load('new_masks.npz')
+        masks.set_row(0, np.ones(8 * 48))
+        masks.save('new_masks.npz')
+        mask_file = (self.out / (df.dataset[0] + '_24x4') / 'masks'
+                     / (df.filename[0] + '.bmp'))
+        self.assertEqual(self.export(), 1)
+        self.assertTrue(np.all(np.array(Image.open(mask_file)) == 255))
+        # A changed checked status
+        df.loc[1, 'checked'] = not df.checked[1]
+        df.to_csv('check_masks_full.csv')
+        self.assertEqual(self.export(), 1)
+        # A missing output file
+        iris_file = (self.out / (df.dataset[2] + '_24x4') / 'iris'
+                     / (df.filename[2] + '.bmp'))
+        iris_file.unlink()
+        self.assertEqual(self.export(), 1)
+        self.assertTrue(iris_file.exists())
+        self.assertEqual(self.export(), 0)
+
+    def test_workers(self):
+        # Two chunks of two rows in flight at a time, out of three
+        row_bytes = 12 * 8 * 48
+        kwargs = {'orig_shape': (8, 48), 'chunk_size': 2,
+                  'max_memory': row_bytes * 2 * 2,
+                  'gen_diff_visualization': True}
+        self.assertEqual(export_masks_as_images(
+            self.out / 'single', [(4, 24)], n_workers=1, **kwargs), 6)
+        self.assertEqual(export_masks_as_images(
+            self.out / 'pool', [(4, 24)], n_workers=2, **kwargs), 6)
+        single = sorted(p.relative_to(self.out / 'single')
+                        for p in (self.out / 'single').rglob('*.*'))
+        pool = sorted(p.relative_to(self.out / 'pool')
+                      for p in (self.out / 'pool').rglob('*.*'))
+        self.assertEqual(single, pool)
+        for path in single:
+            self.assertEqual((self.out / 'single' / path).read_bytes(),
+                             (self.out / 'pool' / path).read_bytes())
+
+    def test_journal(self):
+        self.export()
+        # A row saved to the journal but not compacted into the .npz
+        journal = MaskJournal('new_masks.journal', 8 * 48 // 8)
+        journal.append(3, np.full(8 * 48 // 8, 255, dtype='uint8'), True, 0)
+        journal.close()
+        self.assertEqual(self.export(), 1)
+        df = pd.read_csv('check_masks_full.csv', index_col=0)
+        mask_file = (self.out / (df.dataset[3] + '_24x4') / 'masks'
+                     / (df.filename[3] + '.bmp'))
+        self.assertTrue(np.all(np.array(Image.open(mask_file)) == 255))
+
+
+class TestRegistryExport(SyntheticDatasetCase):
+    n_images = 4
+
+    def setUp(self) -> None:
+        super().setUp()
+        # 'od' images are 8x48 and 'os' images 8x24
+        self.registry, self.row = self.use_mixed_datasets()
+        self.df = pd.read_csv('check_masks_full.csv', index_col=0)
+        self.out = self.root / 'export'
+
+    def test_images(self):
+        self.assertEqual(export_masks_as_images(
+            self.out, [(4, 24), (2, 12)], n_workers=1,
+            registry=self.registry), 4)
+        filename = self.df.filename[self.row] + '.bmp'
+        mask = np.array(Image.open(self.out / 'os_12x2' / 'masks' / filename))
+        self.assertTrue(np.all(mask == 255))
+        iris = Image.open(self.out / 'od_12x2' / 'iris' / (
+            self.df.filename[0] + '.bmp'))
+        self.assertEqual(iris.size, (12, 2))
+
+    def test_shards(self):
+        export_masks_as_shards(self.out, [(2, 12)], registry=self.registry)
+        shards = load_shards(self.out / 'os_12x2')
+        self.assertEqual(list(shards[0]['filenames']),
+                         list(self.df.filename[self.df.dataset == 'os']))
+        masks = unpack_shard_masks(shards[0]['masks'], (2, 12))
+        self.assertTrue(np.all(masks[0] == 1))
+
+
+class TestShards(unittest.TestCase):
+    def test_write_load(self):
+        df = pd.DataFrame({'filename': ['a{}'.format(i) for i in range(5)]})
+        rows = [row for _, row in df.iterrows()]
+        masks = np.random.rand(5, 2, 12) > 0.5
+        with tempfile.TemporaryDirectory() as tmp:
+            shards = _write_shards(Path(tmp), rows, (2, 12), 2)
+            self.assertEqual([(s[0], s[1]) for s in shards],
+                             [(0, 2), (2, 4), (4, 5)])
+            for start, end, arrays in shards:
+                arrays['masks'][:] = np.packbits(
+                    masks[start:end].reshape((end - start, -1)), axis=1)
+                arrays['filenames'][:] = df.filename[start:end]
+            # Shards are not loaded until their index is written
+            with self.assertRaises(FileNotFoundError):
+                load_shards(tmp)
+            _write_shards_index(Path(tmp), shards, (2, 12))
+            loaded = load_shards(tmp)
+            self.assertEqual(len(loaded), 3)
+            self.assertEqual(list(loaded[1]['filenames']), ['a2', 'a3'])
+            unpacked = unpack_shard_masks(loaded[2]['masks'], (2, 12))
+            self.assertTrue(np.all(unpacked == masks[4:]))